@@ -0,0 +1,107 @@
+import threading
+import time
+from flask import g, request
+from sqlalchemy.pool import QueuePool
+
+
+class Overloaded(Exception):
+    """Raised before a request starts when the process is too busy to serve it."""
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that keeps a moving average of how long checkouts waited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.wait = 0.0
+        self.waiting = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        with self._wait_lock:
+            self.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            with self._wait_lock:
+                self.waiting -= 1
+                self.wait = self.wait * 0.8 + (time.perf_counter() - start) * 0.2
+
+    def saturated(self):
+        """True when every connection the pool may open is in use."""
+        return self._max_overflow >= 0 and self.checkedout() >= self.size() + self._max_overflow
+
+
+class AdmissionControl(object):
+    """
+    Turns requests away with a fast 503 and Retry-After instead of letting
+    them queue for a database connection until the worker times out.
+    A request is refused when ADMISSION_MAX_IN_FLIGHT requests are already
+    running in this process (0 means no limit; only threaded or gevent
+    workers run more than one), or when the pool has no free connection
+    and recent checkouts waited longer than ADMISSION_MAX_POOL_WAIT seconds.
+    """
+
+    SKIP_ENDPOINTS = ("static", "metrics")
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pool = lambda: None
+        self.max_in_flight = 0
+        self.max_pool_wait = 0.5
+        self.retry_after = 1
+        self.in_flight = 0
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_MAX_IN_FLIGHT', 0)
+        app.config.setdefault('ADMISSION_MAX_POOL_WAIT', 0.5)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        self.max_in_flight = app.config['ADMISSION_MAX_IN_FLIGHT']
+        self.max_pool_wait = app.config['ADMISSION_MAX_POOL_WAIT']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.register_error_handler(Overloaded, self.overloaded)
+
+    def watch_pool(self, pool):
+        """Register a callable returning the connection pool to watch."""
+        self._pool = pool
+
+    def _before_request(self):
+        if request.endpoint in self.SKIP_ENDPOINTS:
+            return
+        with self._lock:
+            busy = self.max_in_flight and self.in_flight >= self.max_in_flight
+            if not busy:
+                self.in_flight += 1
+                g.admitted = True
+        if busy or self.pool_overloaded():
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded()
+
+    def _teardown_request(self, exc):
+        if g.pop('admitted', False):
+            with self._lock:
+                self.in_flight -= 1
+
+    def pool_overloaded(self):
+        pool = self._pool()
+        return isinstance(pool, TimedQueuePool) and pool.saturated() and pool.wait > self.max_pool_wait
+
+    def overloaded(self, error=None):
+        return "<h1>Server busy, please try again</h1>", 503, {"Retry-After": str(self.retry_after)}
+
+    def stats(self):
+        """In-flight and rejected counts for /metrics."""
+        return [
+            ('http_requests_in_flight', 'gauge', 'Requests being served by this process.', self.in_flight),
+            ('http_requests_shed_total', 'counter', 'Requests refused with 503 by admission control.', self.rejected),
+        ]
+
+
+admission = AdmissionControl()
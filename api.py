@@ -0,0 +1,135 @@
+from flask import Blueprint, current_app, jsonify, request, session
+from werkzeug.datastructures import MultiDict
+from forms import FeedbackForm
+from models import Feedback, User
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@api.errorhandler(APIError)
+def api_error(error):
+    return jsonify(error=error.message), error.status
+
+
+def current_user():
+    """The logged-in username. A session whose account has been deleted is logged out."""
+    username = session.get("user_id")
+    if username is not None and User.get_profile(username) is None:
+        session.pop("user_id")
+        username = None
+    if username is None:
+        raise APIError(401, "Log in first")
+    return username
+
+
+def batch(key):
+    """The list under `key` in the JSON body. Only JSON bodies are read, so
+    a cross-site form post can't reach these routes with the session cookie."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get(key), list):
+        raise APIError(400, "Expected a JSON object with a list of %s" % key)
+    items = body[key]
+    if len(items) > current_app.config['API_MAX_BATCH']:
+        raise APIError(413, "At most %d %s per request" % (current_app.config['API_MAX_BATCH'], key))
+    return items
+
+
+def is_id(value):
+    """JSON true and false decode to bools, which are ints in Python."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate(item, partial=False):
+    """Errors in an item's title and content by FeedbackForm's rules. With
+    `partial`, fields left out of the item are not required."""
+    if not isinstance(item, dict):
+        return {"item": ["Must be an object."]}
+    fields = {key: item[key] for key in ("title", "content") if key in item}
+    errors = {key: ["Must be a string."] for key, value in fields.items() if not isinstance(value, str)}
+    if errors:
+        return errors
+    form = FeedbackForm(formdata=MultiDict(fields), meta={"csrf": False})
+    form.validate()
+    return {key: value for key, value in form.errors.items() if not partial or key in fields}
+
+
+@api.route("/feedback", methods=["GET"])
+def list_feedback():
+    """Feedback the user may see. ?fields=id,title picks the keys returned,
+    ?after=<id> continues from the previous page's `next`."""
+    username = current_user()
+    fields = request.args.get("fields", "id,title,excerpt").split(",")
+    unknown = [name for name in fields if name not in Feedback.API_FIELDS]
+    if unknown:
+        raise APIError(400, "Unknown fields: %s" % ", ".join(unknown))
+    per_page = min(request.args.get("limit", current_app.config['FEEDBACK_PAGE_SIZE'], type=int),
+                   current_app.config['API_MAX_BATCH'])
+    page = Feedback.get_feedback_fields(username, fields, after=request.args.get("after", type=int),
+                                        per_page=max(per_page, 1))
+    for item in page:
+        if item.get("created_at") is not None:
+            item["created_at"] = item["created_at"].isoformat()
+    return jsonify(items=page.items, next=page.next_cursor)
+
+
+@api.route("/feedback", methods=["POST"])
+def create_feedback():
+    """{"items": [{"title": ..., "content": ...}, ...]}. Valid items are
+    created together; each gets a result in request order."""
+    username = current_user()
+    items = batch("items")
+    results = [{"index": index, "status": "invalid", "errors": validate(item)} for index, item in enumerate(items)]
+    valid = [result for result in results if not result["errors"]]
+    ids = Feedback.create_many([(items[r["index"]]["title"], items[r["index"]]["content"]) for r in valid], username)
+    if ids is None:
+        session.pop("user_id")
+        raise APIError(401, "Log in first")
+    for result, id in zip(valid, ids):
+        result.update(status="created", id=id)
+        del result["errors"]
+    return jsonify(results=results)
+
+
+@api.route("/feedback", methods=["PATCH"])
+def update_feedback():
+    """{"items": [{"id": ..., "title": ..., "content": ...}, ...]}, title and
+    content each optional. Items the user may not edit are not_found."""
+    username = current_user()
+    items = batch("items")
+    results, changes = [], {}
+    for index, item in enumerate(items):
+        errors = validate(item, partial=True)
+        id = item.get("id") if isinstance(item, dict) else None
+        if not errors and (not is_id(id) or id in changes):
+            errors = {"id": ["Must be an integer, once per request."]}
+        if not errors and not ("title" in item or "content" in item):
+            errors = {"item": ["Nothing to update."]}
+        if errors:
+            results.append({"index": index, "status": "invalid", "errors": errors})
+            continue
+        changes[id] = {key: item[key] for key in ("title", "content") if key in item}
+        results.append({"index": index, "id": id})
+    updated = Feedback.update_many(changes, username)
+    for result in results:
+        if "id" in result:
+            result["status"] = "updated" if result["id"] in updated else "not_found"
+    return jsonify(results=results)
+
+
+@api.route("/feedback", methods=["DELETE"])
+def delete_feedback():
+    """{"ids": [...]}. Ids the user may not delete are not_found."""
+    username = current_user()
+    ids = batch("ids")
+    if not all(is_id(id) for id in ids):
+        raise APIError(400, "ids must be integers")
+    deleted = Feedback.delete_many(set(ids), username)
+    return jsonify(results=[{"index": index, "id": id, "status": "deleted" if id in deleted else "not_found"}
+                            for index, id in enumerate(ids)])
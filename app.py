@@ -1,139 +1,72 @@
-from flask import Flask, request, redirect, render_template, url_for, session, flash
-from models import db, connect_db, User, Feedback
-from forms import LoginForm, RegisterForm, FeedbackForm
+from flask import Flask, current_app
+from jinja2 import FileSystemBytecodeCache
+from config import Config
 import os
+import time
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///user_feedback')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '123default456key')
 
-connect_db(app)
-
-@app.errorhandler(404)
-def error404(error):
-    return "<h1>Feedback not found</h1>", 404
+def create_app(config=None):
+    """
+    Build the app from Config plus `config`, a dict or object whose settings
+    win over it. The models, extensions and views are imported here rather
+    than at module level, so importing this module stays cheap.
+    """
+    start = time.perf_counter()
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
 
-@app.errorhandler(401)
-def error401(error):
-    return "<h1>User not authorized</h1>", 401
+    from models import db, connect_db, model_stats
+    from admission import admission
+    from assets import assets, assets_cli
+    from buffer import feedback_buffer
+    from deletion import deletion_worker
+    from metrics import metrics
+    from recorder import recorder
+    from cli import data_cli
+    from views import bp
+    from api import api
 
-@app.route("/")
-def do_home():   
-    # session.pop("user_id") 
-    return redirect(url_for("register"))
-    
-@app.route("/register", methods=['GET', 'POST'])
-def register():
-    """Register a new user"""
-    loggedin = session.get("user_id")
-    if loggedin != None:
-        return redirect(url_for("secret", username=loggedin))
-    
-    form = RegisterForm()    
-    if form.validate_on_submit():
-        usr = form.username.data
-        pwd = form.password.data
-        email = form.email.data
-        first_name = form.first_name.data
-        last_name = form.last_name.data
-        reg = User.register_user(usr, pwd, email, first_name, last_name)
-        if reg:
-            session["user_id"] = first_name
-            return redirect(url_for("secret", username=first_name))
-        else:
-            flash("Username and email must be unique")
-    return render_template("register.html", form=form, user=False)            
-        
-@app.route("/login", methods=['GET', 'POST'])
-def login():
-    """Login a user"""
-    loggedin = session.get("user_id")
-    if loggedin != None:
-        return redirect(url_for("secret", username=loggedin))
-    form = LoginForm()
-    if form.validate_on_submit():
-        usr = form.username.data
-        pwd = form.password.data
-        login = User.authenticate(usr, pwd)
-        if login:
-            session["user_id"] = login.username
-            return redirect(url_for("secret", username=login.username))
-        
-        flash(u"username and password don't match", "error")
-    return render_template("login.html", form=form, user=False)
-        
-@app.route("/users/<username>")
-def secret(username):
-    loggedin = session.get("user_id")
-    if loggedin == username:
-        user = User.get_user_by_username(username)
-        feedback = Feedback.get_feedback_by_username(username)
-        return render_template("secret.html", user=user, feedback=feedback)
-    else:
-        return redirect(url_for("register"))    
+    # Compiled templates are kept on disk, so a new worker loads them instead of parsing
+    if app.config['TEMPLATE_CACHE']:
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
 
-@app.route("/users/<username>/delete", methods=['POST'])
-def delete_user(username):
-    """Remove the user from the database and make sure to also delete all of their feedback. Remove the user from the database and make sure to also delete all of their feedback. Clear any user information in the session and redirect to /. Make sure that only the user who is logged in can successfully delete their account"""
-    session.pop("user_id")
-    User.delete_user(username)
-    return redirect(url_for("do_home"))
+    admission.init_app(app)
+    connect_db(app)
+    admission.watch_pool(lambda: db.engine.pool)
+    feedback_buffer.init_app(app)
+    deletion_worker.init_app(app)
+    metrics.init_app(app)
+    metrics.add_source(model_stats)
+    metrics.add_source(admission.stats)
+    metrics.add_source(feedback_buffer.stats)
+    metrics.add_source(deletion_worker.stats)
+    metrics.add_source(startup_stats)
+    app.cli.add_command(data_cli)
+    assets.init_app(app)
+    app.cli.add_command(assets_cli)
+    recorder.init_app(app)
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
 
-@app.route("/users/<username>/feedback/add", methods=['GET', 'POST'])
-def add_feedback(username):
-    """
-    GET - Display a form to add feedback Make sure that only the user who is logged in can see this form
-    POST - Add a new piece of feedback and redirect to /users/<username> — Make sure that only the user who is logged in can successfully add feedback
-    """
-    loggedin = session.get("user_id")
-    if loggedin != username:
-        return redirect(url_for("do_home"))
-    form = FeedbackForm()
-    if form.validate_on_submit():
-        title = form.title.data
-        content = form.content.data
-        feedback = Feedback.create_feedback(title, content, username)
-        return redirect(url_for("do_home"))
-    else:
-        return render_template("add_feedback.html", form=form, username=username)
+    app.config['STARTUP_SECONDS'] = time.perf_counter() - start
+    app.logger.info("app created in %.1f ms", app.config['STARTUP_SECONDS'] * 1000)
+    return app
 
-@app.route("/feedback/<feedback_id>/update", methods=['GET', 'POST'])
-def update_feedback(feedback_id):
-    """
-    GET - Display a form to edit feedback — **Make sure that only the user who has written that feedback can see this form **
-    POST - Update a specific piece of feedback and redirect to /users/<username> — Make sure that only the user who has written that feedback can update it
-    """
-    username = session.get("user_id")    
-    if Feedback.authenticate(feedback_id, username) == False:
-        return redirect(url_for("do_home"))
-    form = FeedbackForm()
-    if form.validate_on_submit():
-        title = form.title.data
-        content = form.content.data
-        feedback = Feedback.update_feedback(feedback_id, title, content)
-        return redirect(url_for("do_home"))
-    else:
-        feedback = Feedback.get_feedback_by_id(feedback_id)
-        return render_template("update_feedback.html", form=form, feedback=feedback)    
-        
-@app.route("/feedback/<feedback_id>/delete", methods=['POST'])
-def delete_feedback(feedback_id):
-    """
-    POST - Delete a specific piece of feedback and redirect to /users/<username> — Make sure that only the user who has written that feedback can delete it
-    """    
-    username = session.get("user_id")
-    if Feedback.authenticate(feedback_id, username) == False:
-        return redirect(url_for("do_home"))
-    
-    if request.method == 'POST':
-        Feedback.delete_feedback(feedback_id)
-    return redirect(url_for("do_home"))
 
-@app.route("/logout")
-def logout():
-    session.pop("user_id")
-    return redirect(url_for("register"))
+def load_templates(app):
+    """Compile every template now. Run before gunicorn forks, so workers
+    start with them in memory."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
 
+def startup_stats():
+    return [('app_startup_seconds', 'gauge', 'Time create_app took in this process.',
+             current_app.config['STARTUP_SECONDS'])]
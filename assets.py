@@ -0,0 +1,174 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup, with_appcontext
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+assets_cli = AppGroup('assets', help="Build fingerprinted, precompressed static files.")
+
+# Worth compressing; images and fonts already are
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+class Assets(object):
+    """
+    Serves static files built by `flask assets build` from static/dist under
+    content-hashed names, so they can be cached forever: a changed file
+    gets a new name. The static_url() template helper maps a file in
+    static/ to its built name, falling back to the plain static URL when
+    nothing has been built.
+
+    Also compresses HTML responses of at least COMPRESS_MIN_SIZE bytes with
+    brotli or gzip, whichever the client prefers. Streamed responses and
+    304s are left alone.
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.max_age = 31536000
+        self._compressed = LRUCache(256, 3600)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_MAX_AGE', 31536000)
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_CACHE_SIZE', 256)
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self._compressed.configure(app.config['COMPRESS_CACHE_SIZE'], 3600)
+        self.load(app)
+        app.add_url_rule('/static/dist/<path:filename>', 'assets', self.send)
+        app.jinja_env.globals['static_url'] = self.url
+        app.after_request(self._compress)
+
+    def load(self, app):
+        """Read static/dist/manifest.json, if the assets have been built."""
+        path = os.path.join(dist_folder(app), 'manifest.json')
+        try:
+            with open(path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, filename):
+        """URL for a file in static/: its fingerprinted copy once built."""
+        if filename in self.manifest:
+            return url_for('assets', filename=self.manifest[filename])
+        return url_for('static', filename=filename)
+
+    def send(self, filename):
+        """A built file, precompressed if the client takes that encoding."""
+        directory = dist_folder(current_app)
+        encoding = negotiate(lambda suffix: os.path.isfile(os.path.join(directory, filename + suffix)))
+        response = send_from_directory(directory, filename + SUFFIXES.get(encoding, ''),
+                                       mimetype=mimetypes.guess_type(filename)[0], cache_timeout=self.max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % self.max_age
+        return response
+
+    # ---------HTML compression-------------
+    def _compress(self, response):
+        config = current_app.config
+        if (not config['COMPRESS_ENABLED'] or response.status_code != 200 or response.mimetype != 'text/html'
+                or response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or response.content_length is None or response.content_length < config['COMPRESS_MIN_SIZE']):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(lambda suffix: suffix != '.br' or brotli is not None)
+        if encoding is None:
+            return response
+        etag, weak = response.get_etag()
+        if etag:
+            # Another representation, so another tag; the view's 304 check
+            # saw the plain one, so check against this one too
+            response.set_etag('%s-%s' % (etag, encoding), weak)
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+        key = (etag, encoding)
+        body = self._compressed.get(key) if etag else None
+        if body is None:
+            body = compress(response.get_data(), encoding, config['COMPRESS_LEVEL'])
+            if etag:
+                self._compressed.set(key, body)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+assets = Assets()
+
+
+def negotiate(available):
+    """The encoding the request accepts with the highest quality, br over
+    gzip on a tie, among those available(suffix) allows. None for identity."""
+    accepted = request.accept_encodings
+    best, quality = None, 0
+    for encoding in ('br', 'gzip'):
+        if accepted[encoding] > quality and available(SUFFIXES[encoding]):
+            best, quality = encoding, accepted[encoding]
+    return best
+
+
+def compress(data, encoding, level=9):
+    if encoding == 'br':
+        # brotli's quality runs 0-11 where gzip's level runs 0-9
+        return brotli.compress(data, quality=min(level + 2, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def dist_folder(app):
+    return os.path.join(app.static_folder, 'dist')
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build():
+    """Copy static/ to static/dist under content-hashed names, with .gz and .br
+    copies of text files where they are smaller, and write manifest.json."""
+    static, dist = current_app.static_folder, dist_folder(current_app)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != dist]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            logical = os.path.relpath(path, static).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(logical)
+            built = '%s.%s%s' % (stem, hashlib.sha256(data).hexdigest()[:12], ext)
+            target = os.path.join(dist, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            sizes = [len(data)]
+            if (mimetypes.guess_type(name)[0] or '').startswith(COMPRESSIBLE):
+                for encoding in ('gzip', 'br') if brotli is not None else ('gzip',):
+                    packed = compress(data, encoding)
+                    if len(packed) < len(data):
+                        with open(target + SUFFIXES[encoding], 'wb') as f:
+                            f.write(packed)
+                        sizes.append(len(packed))
+            manifest[logical] = built
+            click.echo("%s -> %s (%s bytes)" % (logical, built, " / ".join(map(str, sizes))), err=True)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    assets.load(current_app)
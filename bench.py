@@ -0,0 +1,222 @@
+"""
+Micro-benchmarks for the model classmethods and the routes.
+
+Seeds a local database at each size, times every case, counts the SQL it
+runs, and writes the results as JSON. With --baseline the run fails if a
+case got slower than the baseline by more than --tolerance at p50, or
+runs more queries per call than it did.
+
+    python bench.py --database sqlite:////tmp/bench.db --sizes 1000,100000 --output bench.json
+    python bench.py --database postgresql:///feedback_bench --baseline bench.json
+
+The database is dropped and recreated, so never point this at real data.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples, queries):
+    return {
+        "calls": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p90_ms": percentile(samples, 90) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "queries_per_call": queries / float(len(samples)),
+    }
+
+
+def seed(db, User, Feedback, hasher, size, users=100):
+    """Create `users` users plus a bench admin and spread `size` feedback rows over them."""
+    from models import FeedbackSummary
+    db.drop_all()
+    db.create_all()
+    password = hasher.generate_password_hash("BenchPassword")
+    rows = [dict(username="bench%d" % i, password=password, email="bench%d@example.com" % i,
+                 first_name="Bench", last_name=str(i), is_admin=False) for i in range(users)]
+    rows.append(dict(username="benchadmin", password=password, email="benchadmin@example.com",
+                     first_name="Bench", last_name="Admin", is_admin=True))
+    db.session.execute(User.__table__.insert(), rows)
+    chunk = 10000
+    for start in range(0, size, chunk):
+        batch = [dict(title="Feedback %d" % n, content="Benchmark feedback number %d about the checkout page" % n,
+                      username="bench%d" % (n % users)) for n in range(start, min(size, start + chunk))]
+        db.session.execute(Feedback.__table__.insert(), batch)
+    db.session.commit()
+    with db.engine.begin() as connection:
+        FeedbackSummary.rebuild(connection)
+
+
+# Items per request in the /api cases
+API_BATCH = 10
+
+
+def cases(app, db, User, Feedback, calls):
+    """Name -> callable(i). Each call is one iteration; i is its index, below
+    `calls`. Rows the delete routes remove are created up front, so their
+    timings don't include the insert."""
+    owned = [row.id for row in Feedback.query.filter_by(username="bench1").order_by(Feedback.id).limit(1000)]
+    client = app.test_client()
+    client.post("/login", data={"username": "bench1", "password": "BenchPassword"})
+    admin = app.test_client()
+    admin.post("/login", data={"username": "benchadmin", "password": "BenchPassword"})
+    stamp = int(time.time() * 1000)
+    doomed = Feedback.create_many([("Doomed", "Deleted by the benchmark")] * calls, "bench1")
+    doomed_batches = Feedback.create_many([("Doomed", "Deleted by the benchmark")] * (calls * API_BATCH), "bench1")
+    password = User.query.filter_by(username="bench1").one().password
+    leaving = ["d%d_%d" % (stamp % 100000, i) for i in range(calls)]
+    db.session.execute(User.__table__.insert(), [
+        dict(username=usr, password=password, email="%s@example.com" % usr, first_name="Bench", last_name="Leaving",
+             is_admin=False) for usr in leaving])
+    db.session.commit()
+
+    def delete_feedback(i):
+        feedback = Feedback.create_feedback("Doomed", "Deleted by the benchmark", "bench2")
+        Feedback.delete_feedback(feedback.id, "bench2")
+
+    def delete_user(i):
+        # Logging in through the session cookie skips bcrypt, which POST /login covers
+        leaver = app.test_client()
+        with leaver.session_transaction() as session:
+            session["user_id"] = leaving[i]
+        return leaver.post("/users/%s/delete" % leaving[i])
+
+    def batch(i):
+        return [owned[(i * API_BATCH + n) % len(owned)] for n in range(API_BATCH)]
+
+    return {
+        "model.register_user": lambda i: User.register_user(
+            "r%d_%d" % (stamp % 100000, i), "BenchPassword", "r%d_%d@example.com" % (stamp, i), "Bench", "Register"),
+        "model.authenticate": lambda i: User.authenticate("bench1", "BenchPassword"),
+        "model.get_feedback_by_username": lambda i: Feedback.get_feedback_by_username("bench1"),
+        "model.get_feedback_page": lambda i: Feedback.get_feedback_page("bench1"),
+        "model.get_feedback_page.admin": lambda i: Feedback.get_feedback_page("benchadmin"),
+        "model.feedback_authenticate": lambda i: Feedback.authenticate(owned[i % len(owned)], "bench1"),
+        "model.update_feedback": lambda i: Feedback.update_feedback(owned[i % len(owned)], "Updated", "Updated content", "bench1"),
+        "model.delete_feedback": delete_feedback,
+        "model.search": lambda i: Feedback.search("checkout", "bench1"),
+        "route.GET /users/<username>": lambda i: client.get("/users/bench1"),
+        "route.GET /users/<admin>": lambda i: admin.get("/users/benchadmin"),
+        "route.GET /feedback/<id>/update": lambda i: client.get("/feedback/%d/update" % owned[i % len(owned)]),
+        "route.POST /feedback/<id>/update": lambda i: client.post(
+            "/feedback/%d/update" % owned[i % len(owned)], data={"title": "Routed", "content": "Updated by route"}),
+        "route.GET /feedback/search": lambda i: client.get("/feedback/search?q=checkout"),
+        "route.POST /login": lambda i: app.test_client().post(
+            "/login", data={"username": "bench1", "password": "BenchPassword"}),
+        "route.GET /register": lambda i: app.test_client().get("/register"),
+        "route.POST /register": lambda i: app.test_client().post("/register", data={
+            "username": "w%d_%d" % (stamp % 100000, i), "password": "BenchPassword",
+            "email": "w%d_%d@example.com" % (stamp, i), "first_name": "Bench", "last_name": "Register"}),
+        "route.GET /users/<username>/feedback/add": lambda i: client.get("/users/bench1/feedback/add"),
+        "route.POST /users/<username>/feedback/add": lambda i: client.post(
+            "/users/bench1/feedback/add", data={"title": "Added", "content": "Added by route"}),
+        "route.POST /feedback/<id>/delete": lambda i: client.post("/feedback/%d/delete" % doomed[i]),
+        "route.POST /users/<username>/delete": delete_user,
+        "route.GET /admin/summary": lambda i: admin.get("/admin/summary"),
+        "route.GET /api/feedback": lambda i: client.get("/api/feedback"),
+        "route.POST /api/feedback": lambda i: client.post("/api/feedback", json={
+            "items": [{"title": "Batched", "content": "Created by the API"}] * API_BATCH}),
+        "route.PATCH /api/feedback": lambda i: client.patch("/api/feedback", json={
+            "items": [{"id": id, "title": "Patched"} for id in batch(i)]}),
+        "route.DELETE /api/feedback": lambda i: client.delete("/api/feedback", json={
+            "ids": doomed_batches[i * API_BATCH:(i + 1) * API_BATCH]}),
+    }
+
+
+def run_case(fn, iterations, warmup, db, metrics):
+    for i in range(warmup):
+        fn(i)
+        db.session.remove()
+    samples = []
+    before = metrics.query_count
+    for i in range(warmup, warmup + iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+        db.session.remove()
+    return summarize(samples, metrics.query_count - before)
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of human-readable regressions against the baseline results."""
+    regressions = []
+    for size, cases_ in results.items():
+        for name, result in cases_.items():
+            old = baseline.get(size, {}).get(name)
+            if old is None:
+                continue
+            if result["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+                regressions.append("%s @ %s: p50 %.2f ms, baseline %.2f ms" % (name, size, result["p50_ms"], old["p50_ms"]))
+            if result["queries_per_call"] > old["queries_per_call"] + 1e-9:
+                regressions.append("%s @ %s: %.2f queries/call, baseline %.2f" % (
+                    name, size, result["queries_per_call"], old["queries_per_call"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="sqlite:////tmp/flask_feedback_bench.db")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma separated feedback row counts")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=None, help="bcrypt work factor, defaults to the app's")
+    parser.add_argument("--only", default=None, help="run only cases whose name contains this")
+    parser.add_argument("--output", default=None, help="write results JSON here")
+    parser.add_argument("--baseline", default=None, help="results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown, 0.25 = 25%%")
+    args = parser.parse_args(argv)
+
+    config = {"SQLALCHEMY_DATABASE_URI": args.database, "WTF_CSRF_ENABLED": False, "SQL_SLOW_QUERY_MS": float("inf")}
+    if args.rounds is not None:
+        config["BCRYPT_LOG_ROUNDS"] = args.rounds
+    from app import create_app
+    from metrics import metrics
+    from models import db, hasher, user_cache, User, Feedback
+    app = create_app(config)
+
+    results = {}
+    with app.app_context():
+        for size in [int(s) for s in args.sizes.split(",")]:
+            start = time.perf_counter()
+            seed(db, User, Feedback, hasher, size)
+            user_cache.clear()
+            print("seeded %d feedback rows in %.1f s" % (size, time.perf_counter() - start), file=sys.stderr)
+            results[str(size)] = {}
+            for name, fn in sorted(cases(app, db, User, Feedback, args.warmup + args.iterations).items()):
+                if args.only and args.only not in name:
+                    continue
+                result = run_case(fn, args.iterations, args.warmup, db, metrics)
+                results[str(size)][name] = result
+                print("%8d  %-44s p50 %8.2f ms  p99 %8.2f ms  %5.1f q/call" % (
+                    size, name, result["p50_ms"], result["p99_ms"], result["queries_per_call"]), file=sys.stderr)
+
+    report = {
+        "meta": {"database": db.engine.dialect.name, "python": platform.python_version(),
+                 "iterations": args.iterations, "created": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
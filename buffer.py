@@ -0,0 +1,173 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from flask import current_app, has_app_context
+
+
+class FeedbackBuffer(object):
+    """
+    Write-behind queue for new feedback. Off unless FEEDBACK_BUFFER_ENABLED
+    is set. Submissions are held in this process and written by a
+    background thread as multi-row INSERTs with one commit, once
+    FEEDBACK_BUFFER_MAX_ROWS are waiting or the oldest has waited
+    FEEDBACK_BUFFER_MAX_DELAY seconds. The queue is flushed on exit.
+
+    Durability trade-off: a submission is acknowledged before it is
+    committed. If the process is killed without a clean shutdown, up to
+    FEEDBACK_BUFFER_MAX_DELAY seconds (at most FEEDBACK_BUFFER_MAX_ROWS rows)
+    of feedback per worker is lost, and it is missing from pages until the
+    flush. Past FEEDBACK_BUFFER_MAX_PENDING queued rows, for example while
+    the database is down, add() refuses and callers write synchronously.
+    A batch that fails FEEDBACK_BUFFER_MAX_RETRIES flushes in a row is
+    written a row at a time, and rows that still fail are dropped and
+    logged, so one bad row can't hold up the rows queued behind it.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._rows = []
+        self._in_flight = 0
+        self._attempts = 0
+        self._thread = None
+        self._pid = None
+        self._registered = False
+        self.app = None
+        self.flushed = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FEEDBACK_BUFFER_ENABLED', False)
+        app.config.setdefault('FEEDBACK_BUFFER_MAX_ROWS', 500)
+        app.config.setdefault('FEEDBACK_BUFFER_MAX_DELAY', 1.0)
+        app.config.setdefault('FEEDBACK_BUFFER_MAX_PENDING', 10000)
+        app.config.setdefault('FEEDBACK_BUFFER_MAX_RETRIES', 3)
+        self.app = app
+        if not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def add(self, title, content, usr):
+        """Queue a new piece of feedback. False when buffering is off or the
+        queue is full, in which case the caller should write it now."""
+        if has_app_context():
+            # The flusher writes through whichever app queued last
+            self.app = current_app._get_current_object()
+        config = self.app.config
+        if not config['FEEDBACK_BUFFER_ENABLED']:
+            return False
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset()
+            if len(self._rows) >= config['FEEDBACK_BUFFER_MAX_PENDING']:
+                return False
+            self._rows.append(dict(title=title, content=content, username=usr, created_at=datetime.utcnow()))
+            full = len(self._rows) >= config['FEEDBACK_BUFFER_MAX_ROWS']
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='feedback-buffer', daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+        return True
+
+    def _reset(self):
+        """A forked child inherits the parent's rows but not its thread. The
+        parent writes those rows, so start over."""
+        self._rows = []
+        self._thread = None
+        self._wake = threading.Event()
+        self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.app.config['FEEDBACK_BUFFER_MAX_DELAY'])
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("feedback buffer flush failed, will retry")
+                time.sleep(self.app.config['FEEDBACK_BUFFER_MAX_DELAY'])
+
+    def flush(self):
+        """Write everything queued so far. Returns the number of rows written."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._in_flight += len(rows)
+        if not rows:
+            return 0
+        try:
+            return self._write(rows)
+        finally:
+            with self._lock:
+                self._in_flight -= len(rows)
+
+    def _write(self, rows):
+        from models import db, Feedback
+        start = time.perf_counter()
+        dropped = 0
+        with self.app.app_context():
+            try:
+                written = Feedback.insert_batch(rows)
+            except Exception:
+                db.session.rollback()
+                self.failures += 1
+                self._attempts += 1
+                if self._attempts <= self.app.config['FEEDBACK_BUFFER_MAX_RETRIES']:
+                    with self._lock:
+                        # Keep them, ahead of anything queued meanwhile
+                        self._rows[:0] = rows
+                    raise
+                written, dropped = self._write_each(rows)
+            self._attempts = 0
+        self.flushed += written
+        self.dropped += dropped
+        self.skipped += len(rows) - written - dropped
+        self.app.logger.info("flushed %d buffered feedback rows in %.1f ms", written, (time.perf_counter() - start) * 1000)
+        return written
+
+    def _write_each(self, rows):
+        """Last resort for a batch that keeps failing: (written, dropped)."""
+        from models import db, Feedback
+        written = dropped = 0
+        for row in rows:
+            try:
+                written += Feedback.insert_batch([row])
+            except Exception:
+                db.session.rollback()
+                dropped += 1
+                self.app.logger.exception("dropped buffered feedback %r by %s after %d failed flushes",
+                                          row['title'], row['username'], self._attempts)
+        return written, dropped
+
+    def pending(self):
+        """Rows queued or being written."""
+        with self._lock:
+            return len(self._rows) + self._in_flight
+
+    def close(self):
+        """Flush what is left. Runs at interpreter exit."""
+        if self.app is not None and self._pid == os.getpid():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("could not flush %d buffered feedback rows at exit", self.pending())
+
+    def stats(self):
+        """Queue numbers for /metrics."""
+        return [
+            ('feedback_buffer_pending', 'gauge', 'Feedback rows waiting to be written.', self.pending()),
+            ('feedback_buffer_flushed_total', 'counter', 'Buffered feedback rows written.', self.flushed),
+            ('feedback_buffer_skipped_total', 'counter', 'Buffered rows of users deleted before the flush.', self.skipped),
+            ('feedback_buffer_dropped_total', 'counter', 'Buffered rows given up on after FEEDBACK_BUFFER_MAX_RETRIES.',
+             self.dropped),
+            ('feedback_buffer_failures_total', 'counter', 'Flushes that failed and were retried.', self.failures),
+        ]
+
+
+feedback_buffer = FeedbackBuffer()
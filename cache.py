@@ -0,0 +1,91 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Small thread-safe LRU cache whose entries expire after `ttl` seconds.
+    A maxsize of 0 turns it off: every get misses and set does nothing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.hits = 0
+            self.misses = 0
+            self._data.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class PageCache(object):
+    """
+    Rendered pages. Callers key them on a version read from the database
+    that each write bumps in its own transaction, so once a write commits
+    no worker serves a page from before it; `ttl` only bounds memory.
+    """
+
+    def __init__(self, maxsize=0, ttl=0):
+        self._pages = LRUCache(maxsize, ttl)
+
+    def configure(self, maxsize, ttl):
+        self._pages.configure(maxsize if ttl else 0, ttl)
+
+    def get(self, key):
+        """(body, etag) for a cached page, or None."""
+        return self._pages.get(key)
+
+    def set(self, key, body):
+        entry = self.entry(body)
+        self._pages.set(key, entry)
+        return entry
+
+    @staticmethod
+    def entry(body):
+        """(body, strong etag) without caching it."""
+        return (body, hashlib.sha1(body.encode('utf8')).hexdigest())
+
+    def clear(self):
+        self._pages.clear()
+
+    def stats(self):
+        return self._pages.stats()
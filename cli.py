@@ -0,0 +1,228 @@
+import csv
+import io
+import json
+import time
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, inspect
+from sqlalchemy.schema import CreateIndex
+from models import db, rebuild_search, search_installed, FeedbackSummary
+from deletion import deletion_worker
+
+data_cli = AppGroup('data', help="Dump, load, upgrade, index, reindex and reconcile users and feedback, and purge deleted users.")
+
+
+def _tables():
+    """Mapped tables in foreign key order, so users load before their feedback.
+    Derived tables are left out; import rebuilds them."""
+    return [table for table in db.metadata.sorted_tables if not table.info.get('derived')]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode(column, value):
+    if value is not None and isinstance(column.type, DateTime):
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+    return value
+
+
+class Progress(object):
+    """Prints rows and rows/sec to stderr every `every` rows."""
+
+    def __init__(self, label, every):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.start = time.perf_counter()
+
+    def add(self, n):
+        before = self.count
+        self.count += n
+        if self.count // self.every != before // self.every:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        click.echo("%s: %d rows, %.0f rows/sec" % (self.label, self.count, self.count / elapsed), err=True)
+
+
+@data_cli.command('export')
+@click.argument('out', type=click.File('w'))
+@click.option('--batch-size', default=5000, show_default=True, help="Rows fetched per round trip.")
+def export_data(out, batch_size):
+    """Write every table to OUT as JSONL, one {"table", "row"} object per line. Use - for stdout."""
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for table in _tables():
+            progress = Progress(table.name, batch_size * 20)
+            result = conn.execute(table.select().order_by(*table.primary_key.columns))
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    record = {key: _encode(value) for key, value in row.items()}
+                    out.write(json.dumps({"table": table.name, "row": record}) + "\n")
+                progress.add(len(rows))
+            progress.report()
+
+
+@data_cli.command('import')
+@click.argument('src', type=click.File('r'))
+@click.option('--batch-size', default=5000, show_default=True, help="Rows per INSERT or COPY.")
+@click.option('--copy/--no-copy', default=True, show_default=True, help="Use COPY when the database is Postgres.")
+def import_data(src, batch_size, copy):
+    """Load a JSONL file written by `flask data export` in one transaction."""
+    tables = {table.name: table for table in _tables()}
+    use_copy = copy and db.engine.dialect.name == 'postgresql'
+    with db.engine.begin() as conn:
+        table, batch, progress = None, [], None
+        for line in src:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if table is None or record["table"] != table.name:
+                if batch:
+                    _load(conn, table, batch, use_copy)
+                    progress.add(len(batch))
+                    batch = []
+                if progress is not None:
+                    progress.report()
+                table = tables[record["table"]]
+                progress = Progress(table.name, batch_size * 20)
+            batch.append({key: _decode(table.c[key], value) for key, value in record["row"].items()})
+            if len(batch) >= batch_size:
+                _load(conn, table, batch, use_copy)
+                progress.add(len(batch))
+                batch = []
+        if batch:
+            _load(conn, table, batch, use_copy)
+            progress.add(len(batch))
+        if progress is not None:
+            progress.report()
+        if db.engine.dialect.name == 'postgresql':
+            _reset_sequences(conn, tables.values())
+        FeedbackSummary.rebuild(conn)
+
+
+def _load(conn, table, batch, use_copy):
+    if not use_copy:
+        conn.execute(table.insert(), batch)
+        return
+    columns = [column.name for column in table.columns if column.name in batch[0]]
+    buf = io.StringIO()
+    # Strings are quoted, so an unquoted empty field is NULL and "" stays an empty string
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+    for row in batch:
+        writer.writerow([_encode(row.get(name)) for name in columns])
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table.name, ', '.join(columns)), buf)
+
+
+def _reset_sequences(conn, tables):
+    """Move serial sequences past the ids that were just loaded."""
+    for table in tables:
+        pk = list(table.primary_key.columns)
+        if len(pk) == 1 and isinstance(pk[0].type, Integer) and pk[0].autoincrement:
+            conn.execute("SELECT setval(pg_get_serial_sequence('%s', '%s'), coalesce(max(%s), 1)) FROM %s"
+                         % (table.name, pk[0].name, pk[0].name, table.name))
+
+
+@data_cli.command('upgrade')
+def upgrade():
+    """Add the tables and columns the models declare that an existing
+    database lacks. Columns are added nullable, so reads fall back for rows
+    written before them, unless they have a server default to fill those
+    rows with. A new feedback summary is filled in by counting, and a
+    database without search gets it installed and filled as by reindex."""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                table.create(conn)
+                click.echo("created %s" % table.name, err=True)
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(dialect=db.engine.dialect))
+                if column.server_default is not None:
+                    ddl += " DEFAULT %s" % column.server_default.arg
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.execute(ddl)
+                click.echo("added %s.%s" % (table.name, column.name), err=True)
+        if FeedbackSummary.__table__.name not in tables:
+            users = FeedbackSummary.rebuild(conn)
+            click.echo("feedback summary built for %d users" % users, err=True)
+        if not search_installed(conn):
+            rebuild_search(conn)
+            click.echo("search index built", err=True)
+
+
+@data_cli.command('reindex')
+def reindex():
+    """Install the feedback search index on an existing database and fill it."""
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        rebuild_search(conn)
+    click.echo("search index rebuilt in %.1f s" % (time.perf_counter() - start), err=True)
+
+
+@data_cli.command('indexes')
+def create_indexes():
+    """Create the indexes the models declare that an existing database lacks.
+    On Postgres they are built CONCURRENTLY, so writes carry on meanwhile."""
+    inspector = inspect(db.engine)
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                start = time.perf_counter()
+                ddl = str(CreateIndex(index).compile(dialect=db.engine.dialect))
+                if db.engine.dialect.name == 'postgresql':
+                    ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+                conn.execute(ddl)
+                click.echo("created %s in %.1f s" % (index.name, time.perf_counter() - start), err=True)
+
+
+@data_cli.command('reconcile')
+def reconcile():
+    """Rebuild the per-user feedback summary by counting feedback."""
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        users = FeedbackSummary.rebuild(conn)
+    click.echo("feedback summary rebuilt for %d users in %.1f s" % (users, time.perf_counter() - start), err=True)
+
+
+@data_cli.command('purge-deleted')
+@click.option('--batch-size', type=int, help="Feedback rows per transaction. Defaults to USER_DELETE_BATCH_SIZE.")
+def purge_deleted(batch_size):
+    """Finish deleting every deleted user now instead of waiting for the background worker."""
+    start = time.perf_counter()
+
+    def report(usr, rows):
+        if rows:
+            click.echo("%s: %d feedback rows deleted" % (usr, rows), err=True)
+        else:
+            click.echo("%s: user deleted" % usr, err=True)
+
+    total = deletion_worker.drain(batch_size=batch_size, progress=report)
+    click.echo("%d feedback rows deleted in %.1f s" % (total, time.perf_counter() - start), err=True)
@@ -0,0 +1,59 @@
+import os
+
+
+class Config(object):
+    """Settings read from the environment. create_app loads this first, then
+    whatever config it was given on top."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///user_feedback')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 0))
+    ADMISSION_MAX_POOL_WAIT = float(os.environ.get('ADMISSION_MAX_POOL_WAIT', 0.5))
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+    READ_REPLICAS_ENABLED = os.environ.get('READ_REPLICAS_ENABLED') == '1'
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+    REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+    REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO') == '1'
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+    # Bearer token Prometheus sends to scrape /metrics; unset serves no metrics
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    TRAFFIC_RECORD_PATH = os.environ.get('TRAFFIC_RECORD_PATH')
+    TRAFFIC_RECORD_SAMPLE = float(os.environ.get('TRAFFIC_RECORD_SAMPLE', 1.0))
+    SECRET_KEY = os.environ.get('SECRET_KEY', '123default456key')
+    FEEDBACK_PAGE_SIZE = int(os.environ.get('FEEDBACK_PAGE_SIZE', 20))
+    FEEDBACK_STREAM_CHUNK = int(os.environ.get('FEEDBACK_STREAM_CHUNK', 500))
+    API_MAX_BATCH = int(os.environ.get('API_MAX_BATCH', 100))
+    # Write-behind for new feedback: faster submits, but a crashed worker loses
+    # whatever it had not flushed yet. See FeedbackBuffer before turning it on.
+    FEEDBACK_BUFFER_ENABLED = os.environ.get('FEEDBACK_BUFFER_ENABLED') == '1'
+    FEEDBACK_BUFFER_MAX_ROWS = int(os.environ.get('FEEDBACK_BUFFER_MAX_ROWS', 500))
+    FEEDBACK_BUFFER_MAX_DELAY = float(os.environ.get('FEEDBACK_BUFFER_MAX_DELAY', 1.0))
+    FEEDBACK_BUFFER_MAX_PENDING = int(os.environ.get('FEEDBACK_BUFFER_MAX_PENDING', 10000))
+    FEEDBACK_BUFFER_MAX_RETRIES = int(os.environ.get('FEEDBACK_BUFFER_MAX_RETRIES', 3))
+    USER_DELETE_WORKER = os.environ.get('USER_DELETE_WORKER', '1') == '1'
+    USER_DELETE_BATCH_SIZE = int(os.environ.get('USER_DELETE_BATCH_SIZE', 1000))
+    USER_DELETE_BATCH_PAUSE = float(os.environ.get('USER_DELETE_BATCH_PAUSE', 0.1))
+    USER_DELETE_POLL_INTERVAL = float(os.environ.get('USER_DELETE_POLL_INTERVAL', 60))
+    TEMPLATE_STREAM_BUFFER = int(os.environ.get('TEMPLATE_STREAM_BUFFER', 50))
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', 2))
+    BCRYPT_QUEUE_DEPTH = int(os.environ.get('BCRYPT_QUEUE_DEPTH', 16))
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 512))
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 300))
+    ASSETS_MAX_AGE = int(os.environ.get('ASSETS_MAX_AGE', 31536000))
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+    COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', 256))
+    # Without a directory Jinja picks a per-user one that only its owner can
+    # write to, and refuses it if someone else created it
+    TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE', '1') == '1'
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
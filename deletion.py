@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from flask import current_app
+
+
+class DeletionWorker(object):
+    """
+    Removes the feedback of deleted users in the background. User.delete_user
+    only tombstones the account and queues it in pending_deletions; this
+    deletes USER_DELETE_BATCH_SIZE feedback rows per transaction, pausing
+    USER_DELETE_BATCH_PAUSE seconds between batches, so a heavy user's
+    deletion never holds locks on all their rows or writes its WAL in one
+    burst. Progress is committed with each batch, so the worker started by
+    the first request after a restart carries on where the last one
+    stopped. `flask data purge-deleted` drains the queue in the foreground.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self.app = None
+        self.rows_deleted = 0
+        self.users_purged = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_DELETE_WORKER', True)
+        app.config.setdefault('USER_DELETE_BATCH_SIZE', 1000)
+        app.config.setdefault('USER_DELETE_BATCH_PAUSE', 0.1)
+        app.config.setdefault('USER_DELETE_POLL_INTERVAL', 60)
+        self.app = app
+        # Started by a request rather than here, so a preloading master
+        # never runs it and each forked worker gets its own
+        app.before_request(self._ensure_running)
+
+    def _ensure_running(self):
+        if self._pid == os.getpid() or not current_app.config['USER_DELETE_WORKER']:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                self.app = current_app._get_current_object()
+                threading.Thread(target=self._run, name='user-deletion', daemon=True).start()
+
+    def wake(self):
+        """Start on the queue now rather than at the next poll."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.drain(pause=self.app.config['USER_DELETE_BATCH_PAUSE'])
+                except Exception:
+                    self.app.logger.exception("user deletion failed, will retry")
+            self._wake.wait(self.app.config['USER_DELETE_POLL_INTERVAL'])
+            self._wake.clear()
+
+    def drain(self, batch_size=None, pause=0, progress=None):
+        """Purge batches until nothing is pending and return the number of
+        feedback rows deleted. progress(username, rows) is called after each
+        batch, with rows=0 once the user row itself is gone. Needs an app context."""
+        from models import PendingDeletion
+        batch_size = batch_size or current_app.config['USER_DELETE_BATCH_SIZE']
+        total = 0
+        while True:
+            done = PendingDeletion.purge_batch(batch_size)
+            if done is None:
+                return total
+            usr, rows = done
+            total += rows
+            self.rows_deleted += rows
+            if progress is not None:
+                progress(usr, rows)
+            if rows:
+                time.sleep(pause)
+            else:
+                self.users_purged += 1
+                current_app.logger.info("finished deleting user %s", usr)
+
+    def stats(self):
+        """Deletion numbers for /metrics."""
+        from models import PendingDeletion
+        return [
+            ('user_deletions_pending', 'gauge', 'Deleted users whose feedback is still being removed.',
+             PendingDeletion.query.count()),
+            ('user_deletion_rows_total', 'counter', 'Feedback rows removed by the deletion worker.', self.rows_deleted),
+            ('user_deletions_total', 'counter', 'Deleted users purged completely.', self.users_purged),
+        ]
+
+
+deletion_worker = DeletionWorker()
@@ -0,0 +1,193 @@
+"""
+Query plan checks for the model classmethods.
+
+Seeds a local database with bench.seed, runs every case below while
+recording the SQL it sends, and EXPLAINs each statement: EXPLAIN (FORMAT
+JSON) on Postgres, EXPLAIN QUERY PLAN on SQLite. The run fails if a
+statement scans the whole of a table holding at least --min-rows rows,
+unless its case allows that table, or if a model classmethod has no case.
+
+    python explain.py --database sqlite:////tmp/explain.db --size 100000
+    python explain.py --database postgresql:///feedback_explain --verbose
+
+Foreign key cascades run inside the database and have no statement to
+EXPLAIN; they are covered by the indexes the purge cases use.
+
+The database is dropped and recreated, so never point this at real data.
+"""
+import argparse
+import json
+import re
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+# A model call to check. `allow` maps tables it may scan in full to why.
+Case = namedtuple('Case', ['name', 'call', 'allow'])
+
+# Classmethods with no case of their own, and why
+UNCHECKED = {
+    'User.active': "builds a query for the create and ownership cases",
+    'User.forget': "cache invalidation, no SQL",
+    'User.update_user': "unused",
+    'Feedback.make_excerpt': "no SQL",
+    'Feedback.row_columns': "builds columns for the listing cases",
+    'Feedback.owned_by': "builds a condition for the ownership cases",
+    'FeedbackSummary.record_created': "runs in the create cases",
+    'FeedbackSummary.record_deleted': "runs in the delete cases",
+    'FeedbackSummary.record_updated': "runs in the update cases",
+}
+
+EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+# "SCAN feedback" or, before SQLite 3.36, "SCAN TABLE feedback"; also full
+# index scans. FTS lookups show up as "SCAN feedback_fts VIRTUAL TABLE ...".
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*VIRTUAL TABLE)')
+
+
+def cases(db, User, Feedback, FeedbackSummary, PendingDeletion):
+    owned = Feedback.query.filter_by(username="bench1").order_by(Feedback.id).limit(3).all()
+    first, last = owned[0].id, owned[-1].id
+    now = datetime.utcnow()
+    every_row = {'feedback': "returns every row"}
+    admin_page = {'feedback': "admins page through all feedback in id order, stopping at the LIMIT"}
+
+    def rebuild():
+        with db.engine.begin() as connection:
+            return FeedbackSummary.rebuild(connection)
+
+    return [
+        Case('User.register_user', lambda: User.register_user(
+            "explain1", "BenchPassword", "explain1@example.com", "Explain", "Register"), {}),
+        Case('User.authenticate', lambda: User.authenticate("bench1", "BenchPassword"), {}),
+        Case('User.get_user_by_username', lambda: User.get_user_by_username("bench1"), {}),
+        Case('User.get_profile', lambda: User.get_profile("bench1"), {}),
+        Case('User.delete_user', lambda: User.delete_user("bench3"), {}),
+        Case('PendingDeletion.purge_batch', lambda: PendingDeletion.purge_batch(100), {}),
+        Case('Feedback.create_feedback', lambda: Feedback.create_feedback("Explain", "Explain content", "bench1"), {}),
+        Case('Feedback.create_many', lambda: Feedback.create_many([("Explain", "Explain content")] * 3, "bench1"), {}),
+        Case('Feedback.insert_batch', lambda: Feedback.insert_batch(
+            [dict(title="Explain", content="Buffered", username="bench%d" % n, created_at=now) for n in (1, 2)]), {}),
+        Case('Feedback.get_feedback_by_username', lambda: Feedback.get_feedback_by_username("bench1"), {}),
+        Case('Feedback.get_feedback_by_username.admin', lambda: Feedback.get_feedback_by_username("benchadmin"), every_row),
+        Case('Feedback.get_feedback_page', lambda: Feedback.get_feedback_page("bench1"), {}),
+        Case('Feedback.get_feedback_page.after', lambda: Feedback.get_feedback_page("bench1", after=first), {}),
+        Case('Feedback.get_feedback_page.before', lambda: Feedback.get_feedback_page("bench1", before=last), {}),
+        Case('Feedback.get_feedback_page.admin', lambda: Feedback.get_feedback_page("benchadmin"), admin_page),
+        Case('Feedback.iter_feedback', lambda: list(Feedback.iter_feedback("bench1")), {}),
+        Case('Feedback.iter_feedback.admin', lambda: list(Feedback.iter_feedback("benchadmin")), every_row),
+        Case('Feedback.count_feedback', lambda: Feedback.count_feedback("bench1"), {}),
+        Case('Feedback.count_feedback.admin', lambda: Feedback.count_feedback("benchadmin", True), {}),
+        Case('Feedback.search', lambda: Feedback.search("checkout", "bench1"), {}),
+        Case('Feedback.get_feedback_by_id', lambda: Feedback.get_feedback_by_id(first, "bench1"), {}),
+        Case('Feedback.get_feedback_fields', lambda: Feedback.get_feedback_fields("bench1", ["id", "title"], after=first), {}),
+        Case('Feedback.get_feedback_fields.admin', lambda: Feedback.get_feedback_fields("benchadmin", ["id"]), admin_page),
+        Case('Feedback.authenticate', lambda: Feedback.authenticate(first, "bench1"), {}),
+        Case('Feedback.update_feedback', lambda: Feedback.update_feedback(first, "Explain", "Updated", "bench1"), {}),
+        Case('Feedback.update_many', lambda: Feedback.update_many({first: {"title": "Explain"}}, "bench1"), {}),
+        Case('Feedback.delete_feedback', lambda: Feedback.delete_feedback(last, "bench1"), {}),
+        Case('Feedback.delete_many', lambda: Feedback.delete_many({first}, "bench1"), {}),
+        Case('FeedbackSummary.get_version', lambda: FeedbackSummary.get_version("bench1"), {}),
+        Case('FeedbackSummary.get_summary_page', lambda: FeedbackSummary.get_summary_page(after="bench1"), {}),
+        Case('FeedbackSummary.rebuild', rebuild, {'feedback': "recounts everything, an offline repair",
+                                                 'feedback_summary': "recounts everything, an offline repair"}),
+    ]
+
+
+def classmethods(*models):
+    """'Model.name' for every classmethod the models define."""
+    return {"%s.%s" % (model.__name__, name) for model in models
+            for name, value in vars(model).items() if isinstance(value, classmethod)}
+
+
+def plan(raw, dialect, statement, parameters):
+    """(table, detail) for every full table scan in the statement's plan."""
+    cursor = raw.cursor()
+    try:
+        if dialect == 'postgresql':
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            tree = cursor.fetchone()[0]
+            tree = json.loads(tree) if isinstance(tree, str) else tree
+            return list(_seq_scans(tree[0]['Plan']))
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [(match.group(1), detail) for detail in (row[-1] for row in cursor.fetchall())
+                for match in [SQLITE_SCAN.match(detail)] if match]
+    finally:
+        cursor.close()
+
+
+def _seq_scans(node):
+    if node['Node Type'] == 'Seq Scan':
+        yield node['Relation Name'], "Seq Scan on %s" % node['Relation Name']
+    for child in node.get('Plans', []):
+        yield from _seq_scans(child)
+
+
+def check(db, case, captured, sizes, min_rows, verbose):
+    """Problems with the plans of the statements the case ran."""
+    problems = []
+    raw = db.engine.raw_connection()
+    try:
+        for statement, parameters in captured:
+            if not EXPLAINABLE.match(statement):
+                continue
+            scans = plan(raw, db.engine.dialect.name, statement, parameters)
+            if verbose:
+                print("  %s\n    %s" % (" ".join(statement.split())[:160], scans or "no full scans"), file=sys.stderr)
+            for table, detail in scans:
+                if sizes.get(table, 0) >= min_rows and table not in case.allow:
+                    problems.append("%s: %s (%d rows) in %s" % (case.name, detail, sizes[table], " ".join(statement.split())[:120]))
+    finally:
+        raw.close()
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="sqlite:////tmp/flask_feedback_explain.db")
+    parser.add_argument("--size", type=int, default=100000, help="feedback rows to seed")
+    parser.add_argument("--min-rows", type=int, default=1000, help="smallest table a full scan is a failure on")
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt work factor for the seeded users")
+    parser.add_argument("--verbose", action="store_true", help="print every statement and its scans")
+    args = parser.parse_args(argv)
+
+    from sqlalchemy import event, func, text
+    from app import create_app
+    from bench import seed
+    from models import db, hasher, user_cache, User, Feedback, FeedbackSummary, PendingDeletion
+    app = create_app({"SQLALCHEMY_DATABASE_URI": args.database, "SQL_SLOW_QUERY_MS": float("inf"),
+                      "BCRYPT_LOG_ROUNDS": args.rounds, "USER_DELETE_WORKER": False})
+
+    problems = []
+    with app.app_context():
+        seed(db, User, Feedback, hasher, args.size)
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+        sizes = {table.name: db.session.query(func.count()).select_from(table).scalar()
+                 for table in db.metadata.sorted_tables}
+        print("seeded %s" % ", ".join("%s=%d" % item for item in sorted(sizes.items())), file=sys.stderr)
+
+        captured = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, parameters, context, executemany: captured.append(
+                         (statement, parameters[0] if executemany else parameters)))
+        checked = set()
+        for case in cases(db, User, Feedback, FeedbackSummary, PendingDeletion):
+            user_cache.clear()
+            del captured[:]
+            case.call()
+            db.session.remove()
+            checked.add(".".join(case.name.split(".")[:2]))
+            found = check(db, case, list(captured), sizes, args.min_rows, args.verbose)
+            problems += found
+            print("%-42s %s" % (case.name, "FULL SCAN" if found else "ok"), file=sys.stderr)
+
+    for name in sorted(classmethods(User, Feedback, FeedbackSummary, PendingDeletion) - checked - set(UNCHECKED)):
+        problems.append("%s: no case, add one to explain.py" % name)
+    for line in problems:
+        print("PROBLEM " + line, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Gunicorn settings, read from the environment.
+
+GUNICORN_WORKER_CLASS=gevent runs each worker as a gevent hub serving up
+to GUNICORN_WORKER_CONNECTIONS requests at once: while one request waits
+on Postgres the others run. That needs:
+
+* psycopg2 made cooperative with psycogreen;
+* bcrypt kept off the hub, which PasswordHasher does by using gevent's
+  pool of real threads when threading is monkey-patched;
+* one database session per request, which Flask-SQLAlchemy already
+  gives us because its scope follows the current greenlet.
+
+Database work per worker is still bounded by DB_POOL_SIZE + DB_MAX_OVERFLOW;
+set ADMISSION_MAX_IN_FLIGHT to shed requests beyond what the pool can serve.
+
+The app is loaded once in the master (GUNICORN_PRELOAD=1, the default) and
+workers fork from it, so they boot without importing or compiling anything.
+Each worker then drops the connections and threads it inherited.
+
+With FEEDBACK_BUFFER_ENABLED, a worker writes its queued feedback as it
+exits. That covers restarts and graceful shutdown, not a SIGKILL or a
+worker killed for hitting GUNICORN_TIMEOUT.
+"""
+import os
+import time
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 2))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+if worker_class == "gevent":
+    # Patch before the preloaded app imports threading, sockets or psycopg2
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+    if preload_app:
+        from models import reset_after_fork
+        reset_after_fork()
+
+
+def post_worker_init(worker):
+    worker.log.info("worker %s booted in %.1f ms", worker.pid, (time.perf_counter() - worker.boot_started) * 1000)
+
+
+def worker_exit(server, worker):
+    from buffer import feedback_buffer
+    feedback_buffer.close()
@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask_bcrypt import Bcrypt
+
+
+def _executor_class():
+    """Under gevent, threading is patched to greenlets, so a plain
+    ThreadPoolExecutor would hash on the hub and stall every request.
+    gevent's own executor runs on real OS threads."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return ThreadPoolExecutor
+    if monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+        return GeventThreadPoolExecutor
+    return ThreadPoolExecutor
+
+
+class HashingBusy(Exception):
+    """Raised when every hashing slot is taken for longer than BCRYPT_QUEUE_TIMEOUT."""
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt on a small pool of threads instead of the request worker.
+    bcrypt releases the GIL, so the pool bounds how many cores hashing can
+    take at once, and BCRYPT_QUEUE_DEPTH bounds how many requests may wait
+    for it. Past that, callers get HashingBusy rather than piling up.
+    """
+
+    def __init__(self, app=None):
+        self.bcrypt = Bcrypt()
+        self.rounds = 12
+        self.pool_size = 2
+        self.queue_depth = 16
+        self.queue_timeout = 2.0
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_POOL_SIZE', 2)
+        app.config.setdefault('BCRYPT_QUEUE_DEPTH', 16)
+        app.config.setdefault('BCRYPT_QUEUE_TIMEOUT', 2.0)
+        self.bcrypt.init_app(app)
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.pool_size = app.config['BCRYPT_POOL_SIZE']
+        self.queue_depth = app.config['BCRYPT_QUEUE_DEPTH']
+        self.queue_timeout = app.config['BCRYPT_QUEUE_TIMEOUT']
+        self.reset()
+
+    def reset(self):
+        """Forget the worker threads. They are started again on first use, so this is safe to call after fork."""
+        with self._lock:
+            self._executor = None
+            self._slots = threading.BoundedSemaphore(self.pool_size + self.queue_depth)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = _executor_class()(max_workers=self.pool_size, thread_name_prefix='bcrypt')
+            return self._executor
+
+    def _run(self, fn, *args):
+        slots = self._slots
+        if not slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        return future.result()
+
+    def generate_password_hash(self, pwd):
+        hashed = self._run(self.bcrypt.generate_password_hash, pwd, self.rounds)
+        return hashed.decode("utf8")
+
+    def check_password_hash(self, pw_hash, pwd):
+        return self._run(self.bcrypt.check_password_hash, pw_hash, pwd)
+
+    def needs_rehash(self, pw_hash):
+        """True when pw_hash was made with a different work factor than BCRYPT_LOG_ROUNDS."""
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
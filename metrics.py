@@ -0,0 +1,137 @@
+import hmac
+import threading
+import time
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Metrics(object):
+    """
+    Counts queries and database time per request, logs slow statements with
+    the route that ran them, and serves route latency histograms, query
+    counts and pool stats at /metrics in the Prometheus text format.
+    Numbers are per process; each gunicorn worker reports its own.
+
+    /metrics answers only requests carrying `Authorization: Bearer
+    <METRICS_TOKEN>`, and is not served at all while METRICS_TOKEN is unset.
+    A request is counted when its context is torn down, so queries a
+    streamed response makes while it is being sent count toward its route.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._listening = False
+        self.slow_query_ms = 200
+        self.logger = None
+        self.token = None
+        self.query_count = 0
+        self.routes = {}
+        self.sources = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_SLOW_QUERY_MS', 200)
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.slow_query_ms = app.config['SQL_SLOW_QUERY_MS']
+        self.token = app.config['METRICS_TOKEN']
+        self.logger = app.logger
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'handle_error', self._handle_error)
+            self._listening = True
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+
+    def add_source(self, source):
+        """Register a callable returning (name, type, help, value) tuples to include in /metrics."""
+        if source not in self.sources:
+            self.sources.append(source)
+
+    # ---------SQL--------------------------
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        with self._lock:
+            self.query_count += 1
+        endpoint = '-'
+        if has_request_context():
+            g.db_queries = g.get('db_queries', 0) + 1
+            g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+            endpoint = request.endpoint
+        if elapsed * 1000 >= self.slow_query_ms:
+            self.logger.warning("slow query %.1f ms in %s: %s", elapsed * 1000, endpoint, statement)
+
+    def _handle_error(self, context):
+        # A statement that fails never reaches after_cursor_execute
+        if context.connection is not None and context.execution_context is not None:
+            starts = context.connection.info.get('query_start')
+            if starts:
+                starts.pop()
+
+    # ---------Requests---------------------
+    def _before_request(self):
+        g.request_start = time.perf_counter()
+
+    def _teardown_request(self, exc):
+        start = g.pop('request_start', None)
+        if start is not None:
+            self.observe(request.endpoint or '-', time.perf_counter() - start,
+                         g.get('db_queries', 0), g.get('db_seconds', 0.0))
+
+    def observe(self, endpoint, seconds, queries, db_seconds):
+        with self._lock:
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = {
+                    'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0,
+                    'queries': 0, 'db_seconds': 0.0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    route['buckets'][i] += 1
+            route['count'] += 1
+            route['sum'] += seconds
+            route['queries'] += queries
+            route['db_seconds'] += db_seconds
+
+    # ---------Exposition-------------------
+    def render(self):
+        if not self.token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + self.token):
+            abort(401)
+        lines = []
+        with self._lock:
+            routes = {name: dict(route, buckets=list(route['buckets'])) for name, route in self.routes.items()}
+        lines.append('# HELP http_request_duration_seconds Request latency by endpoint.')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for name, route in sorted(routes.items()):
+            for bound, count in zip(self.BUCKETS, route['buckets']):
+                lines.append('http_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (name, bound, count))
+            lines.append('http_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (name, route['count']))
+            lines.append('http_request_duration_seconds_sum{endpoint="%s"} %f' % (name, route['sum']))
+            lines.append('http_request_duration_seconds_count{endpoint="%s"} %d' % (name, route['count']))
+        lines.append('# HELP db_queries_total SQL statements executed by endpoint.')
+        lines.append('# TYPE db_queries_total counter')
+        for name, route in sorted(routes.items()):
+            lines.append('db_queries_total{endpoint="%s"} %d' % (name, route['queries']))
+        lines.append('# HELP db_query_seconds_total Time spent in SQL by endpoint.')
+        lines.append('# TYPE db_query_seconds_total counter')
+        for name, route in sorted(routes.items()):
+            lines.append('db_query_seconds_total{endpoint="%s"} %f' % (name, route['db_seconds']))
+        for source in self.sources:
+            for name, kind, help_text, value in source():
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s %s' % (name, value))
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
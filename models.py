@@ -1,15 +1,117 @@
-from flask_sqlalchemy import SQLAlchemy 
-from sqlalchemy import Column, String, Integer, Boolean
+import sqlite3
+from collections import Counter, namedtuple
+from datetime import datetime
+from flask import g, has_request_context
+from sqlalchemy import Column, String, Integer, Boolean, and_, bindparam, column, func, literal_column, or_, table, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from flask_bcrypt import Bcrypt 
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.exc import FlushError
+from hashing import PasswordHasher
+from cache import LRUCache, PageCache
+from routing import RoutingSQLAlchemy, RoutingSession
+from admission import TimedQueuePool
+from deletion import deletion_worker
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
-bcrypt = Bcrypt()
+hasher = PasswordHasher()
+
+# Display fields shared across requests: email and names, never the password
+# hash. Whether the account exists and is an admin is read fresh every request.
+user_cache = LRUCache()
+
+# Rendered dashboards, keyed on the owner's feedback_summary.version.
+page_cache = PageCache()
+
+UserProfile = namedtuple('UserProfile', ['username', 'email', 'first_name', 'last_name', 'is_admin'])
+UserDisplay = namedtuple('UserDisplay', ['email', 'first_name', 'last_name'])
+
+# What listings show of a feedback row. Built from a column query, so no
+# ORM object or identity map entry is created per row.
+FeedbackRow = namedtuple('FeedbackRow', ['id', 'title', 'excerpt', 'username'])
+
+# One line of the admin summary: a user and their feedback_summary counters.
+SummaryRow = namedtuple('SummaryRow', ['username', 'first_name', 'last_name', 'feedback_count', 'last_feedback_at'])
 
 def connect_db(app):
+    app.config.setdefault('FEEDBACK_PAGE_SIZE', 20)
+    app.config.setdefault('FEEDBACK_PAGE_TOTALS', True)
+    app.config.setdefault('FEEDBACK_STREAM_CHUNK', 500)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # SQLite's pools don't take these; everything else gets a bounded QueuePool
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('poolclass', TimedQueuePool)
+        options.setdefault('pool_size', app.config.setdefault('DB_POOL_SIZE', 5))
+        options.setdefault('max_overflow', app.config.setdefault('DB_MAX_OVERFLOW', 10))
+        options.setdefault('pool_timeout', app.config.setdefault('DB_POOL_TIMEOUT', 5))
+        options.setdefault('pool_recycle', app.config.setdefault('DB_POOL_RECYCLE', 1800))
+        options.setdefault('pool_pre_ping', app.config.setdefault('DB_POOL_PRE_PING', True))
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
+    user_cache.configure(app.config.setdefault('USER_CACHE_SIZE', 1024),
+                         app.config.setdefault('USER_CACHE_TTL', 60))
+    page_cache.configure(app.config.setdefault('PAGE_CACHE_SIZE', 512),
+                         app.config.setdefault('PAGE_CACHE_TTL', 300))
+
+@db.event.listens_for(Engine, 'connect')
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys unless asked, so deleting a user would
+    leave their feedback and summary behind where Postgres cascades."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def reset_after_fork():
+    """Drop the database connections and bcrypt threads a forked worker
+    inherited from its parent, so it opens its own."""
+    if db.app is not None:
+        db.get_engine(db.app).dispose()
+    db.dispose_replicas()
+    hasher.reset()
+
+def model_stats():
+    """Pool, replica and cache numbers for /metrics."""
+    cache = user_cache.stats()
+    stats = [
+        ('user_cache_hits_total', 'counter', 'Profile lookups served from user_cache.', cache['hits']),
+        ('user_cache_misses_total', 'counter', 'Profile lookups that missed user_cache.', cache['misses']),
+        ('user_cache_size', 'gauge', 'Profiles held in user_cache.', cache['size']),
+        ('page_cache_hits_total', 'counter', 'Dashboards served from page_cache.', page_cache.stats()['hits']),
+    ]
+    pool = db.engine.pool
+    if hasattr(pool, 'checkedout'):
+        stats += [
+            ('db_pool_size', 'gauge', 'Configured pool size.', pool.size()),
+            ('db_pool_checked_out', 'gauge', 'Connections in use.', pool.checkedout()),
+            ('db_pool_overflow', 'gauge', 'Connections open beyond the pool size.', pool.overflow()),
+        ]
+    if isinstance(pool, TimedQueuePool):
+        stats += [
+            ('db_pool_waiting', 'gauge', 'Checkouts waiting for a connection.', pool.waiting),
+            ('db_pool_wait_seconds', 'gauge', 'Moving average of connection checkout wait.', pool.wait),
+        ]
+    replicas = db.replicas()
+    if replicas:
+        stats += [
+            ('db_replica_lag_seconds', 'gauge', 'Largest lag measured on a read replica.', max(r.lag for r in replicas)),
+            ('db_replicas_healthy', 'gauge', 'Read replicas that answered the last lag check.', sum(r.healthy for r in replicas)),
+        ]
+    return stats
+
+def request_memo(name):
+    """Dict that lives for the current request only. Outside a request
+    every call gets a fresh dict, so nothing is memoized."""
+    if not has_request_context():
+        return {}
+    memo = g.get(name)
+    if memo is None:
+        memo = {}
+        setattr(g, name, memo)
+    return memo
 
 class User(db.Model):
     
@@ -21,42 +123,90 @@ class User(db.Model):
     first_name = db.Column(db.String(30), nullable=False)
     last_name = db.Column(db.String(30), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    # Set by delete_user; the row stays until DeletionWorker has removed their feedback
+    deleted_at = db.Column(db.DateTime)
     feedback = db.relationship('Feedback', backref='users', passive_deletes=True)
     
     @classmethod
     def register_user(cls, usr, pwd, email, first, last):
-        
-        hashed = bcrypt.generate_password_hash(pwd)
-        hashed_utf8 = hashed.decode("utf8")
-        reg_usr = cls.query.filter_by(username=usr).first()
-        reg_pwd = cls.query.filter_by(password=hashed_utf8).first()
-        reg_email= cls.query.filter_by(email=email).first()
-        if reg_usr or reg_pwd or reg_email:
-            return False
+        """Insert a new user. Returns False if the username or email is taken,
+        which the primary key and the unique email constraint report for us."""
+        hashed_utf8 = hasher.generate_password_hash(pwd)
         user = User(username=usr, password=hashed_utf8, email=email, first_name=first, last_name=last)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except (IntegrityError, FlushError):
+            # FlushError: the session already holds a user with this username
+            db.session.rollback()
+            return False
         return user
         
     @classmethod
     def authenticate(cls, usr, pwd):        
-        user = User.query.filter_by(username=usr).first()                
-        if user and bcrypt.check_password_hash(user.password, pwd):
+        user = User.query.filter_by(username=usr, deleted_at=None).first()
+        if user and hasher.check_password_hash(user.password, pwd):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.generate_password_hash(pwd)
+                db.session.commit()
             return user
         else: 
             return False
     
     @classmethod
+    @db.replica_read
     def get_user_by_username(cls, usr):
-        user = User.query.filter_by(username=usr).first()
-        return user
+        """Full User row. query.get answers from the session's identity map
+        when this request has already loaded the user. None for deleted users."""
+        user = cls.query.get(usr)
+        return user if user is not None and user.deleted_at is None else None
+    
+    @classmethod
+    @db.primary_read
+    def get_profile(cls, usr):
+        """Display fields and the admin flag, without the password hash, or
+        None for missing and deleted users. Memoized for the request. Only
+        the display fields are cached across requests, in user_cache; the
+        admin flag and the tombstone decide access, so each request reads
+        them from the primary, where the display fields are read too."""
+        memo = request_memo('user_profiles')
+        if usr in memo:
+            return memo[usr]
+        active = (cls.username == usr, cls.deleted_at == None)
+        display = user_cache.get(usr)
+        if display is None:
+            row = db.session.query(cls.username, cls.email, cls.first_name, cls.last_name, cls.is_admin).filter(*active).first()
+            profile = UserProfile._make(row) if row is not None else None
+            if profile is not None:
+                user_cache.set(usr, UserDisplay(profile.email, profile.first_name, profile.last_name))
+        else:
+            row = db.session.query(cls.is_admin).filter(*active).first()
+            profile = UserProfile(usr, *display, is_admin=row.is_admin) if row is not None else None
+        memo[usr] = profile
+        return profile
+    
+    @classmethod
+    def active(cls, usr):
+        """Query for usr's username, empty once the account is deleted."""
+        return db.session.query(cls.username).filter(cls.username == usr, cls.deleted_at == None)
+    
+    @classmethod
+    def forget(cls, usr):
+        """Drop usr from the profile caches. Runs once a transaction that
+        updated or deleted the User through the ORM ends, which covers
+        update_user and delete_user. Cached pages are keyed on the profile,
+        so they go with it."""
+        user_cache.delete(usr)
+        request_memo('user_profiles').pop(usr, None)
     
     @classmethod
     def update_user(cls, from_user, to_user):
         """This function is not in use. It is just for future enhancements if needed."""
         if from_user.username != to_user.username:
             """User is changing username"""
-            cls.delete_user(from_user.username)
+            # Deleted outright: a tombstone would keep the email taken
+            db.session.delete(from_user)
+            db.session.commit()
             user = cls.register_user(to_user.username, to_user.password, to_user.email, to_user.first_name, to_user.last_name)            
             return user
         else:
@@ -69,61 +219,572 @@ class User(db.Model):
         
     @classmethod
     def delete_user(cls, usr):
-        user = cls.query.filter_by(username=usr).first()
-        db.session.delete(user)
+        """Tombstone usr and queue their feedback for DeletionWorker, which
+        removes it in batches and then the user row. From now on they can't
+        log in and aren't shown. Returns False if there is no such user."""
+        user = cls.query.filter_by(username=usr, deleted_at=None).first()
+        if user is None:
+            return False
+        user.deleted_at = datetime.utcnow()
+        db.session.add(PendingDeletion(username=usr, requested_at=user.deleted_at))
         db.session.commit()
+        deletion_worker.wake()
+        return user
+        
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _note_changed_user(mapper, connection, user):
+    object_session(user).info.setdefault('changed_users', set()).add(user.username)
+
+
+# Only once the change is committed: forgetting at flush time would let a
+# concurrent request cache the old row again before the commit. Rollbacks
+# forget too, since a savepoint rollback also drops the outer transaction's notes.
+@db.event.listens_for(RoutingSession, 'after_commit')
+@db.event.listens_for(RoutingSession, 'after_rollback')
+def _forget_changed_users(session):
+    for usr in session.info.pop('changed_users', ()):
+        User.forget(usr)
         
             
 class Feedback(db.Model):
     
     __tablename__ = 'feedback'
+    __table_args__ = (
+        # A user's feedback in id order: listings, keyset pages, purges and the users cascade
+        db.Index('ix_feedback_username_id', 'username', 'id'),
+        # Newest feedback per user, for feedback_summary.last_feedback_at
+        db.Index('ix_feedback_username_created_at', 'username', 'created_at'),
+    )
+    
+    EXCERPT_LENGTH = 200
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # Only loaded when asked for; listings read excerpt instead
+    content = db.deferred(db.Column(db.Text, nullable=False))
+    excerpt = db.Column(db.String(EXCERPT_LENGTH))
     username = db.Column(db.String(20), db.ForeignKey('users.username', ondelete='CASCADE'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @classmethod
+    def make_excerpt(cls, content):
+        if len(content) <= cls.EXCERPT_LENGTH:
+            return content
+        return content[:cls.EXCERPT_LENGTH - 1].rstrip() + "\u2026"
+    
+    @classmethod
+    def row_columns(cls):
+        """Columns for FeedbackRow. Rows written before excerpt existed fall
+        back to a prefix of content."""
+        return (cls.id, cls.title,
+                func.coalesce(cls.excerpt, func.substr(cls.content, 1, cls.EXCERPT_LENGTH)).label('excerpt'),
+                cls.username)
     
     # ---------Create------------------------
     @classmethod
     def create_feedback(cls, title, content, usr):
-        feedback = Feedback(title=title, content=content, username=usr)
+        """None if usr has been deleted."""
+        if not db.session.query(User.active(usr).exists()).scalar():
+            return None
+        now = datetime.utcnow()
+        feedback = Feedback(title=title, content=content, excerpt=cls.make_excerpt(content), username=usr, created_at=now)
         db.session.add(feedback)
+        db.session.flush()
+        FeedbackSummary.record_created(usr, now)
         db.session.commit()
         return feedback
     
+    @classmethod
+    def create_many(cls, items, usr):
+        """Insert (title, content) pairs for usr in one transaction and return
+        their ids in order: a single multi-row INSERT ... RETURNING on Postgres,
+        one ORM flush elsewhere. None if usr has been deleted."""
+        if not db.session.query(User.active(usr).exists()).scalar():
+            return None
+        if not items:
+            return []
+        now = datetime.utcnow()
+        rows = [dict(title=title, content=content, excerpt=cls.make_excerpt(content), username=usr, created_at=now)
+                for title, content in items]
+        if db.engine.dialect.name == 'postgresql':
+            ids = [id for id, in db.session.execute(cls.__table__.insert().values(rows).returning(cls.id))]
+        else:
+            feedback = [Feedback(**row) for row in rows]
+            db.session.add_all(feedback)
+            db.session.flush()
+            ids = [f.id for f in feedback]
+        FeedbackSummary.record_created(usr, now, len(ids))
+        db.session.commit()
+        return ids
+
+    # Rows per INSERT statement, well under SQLite's bound parameter limit
+    INSERT_CHUNK = 100
+
+    @classmethod
+    def insert_batch(cls, rows):
+        """Write rows queued by the feedback buffer (dicts of title, content,
+        username and created_at, from any users) as multi-row INSERTs in one
+        transaction. Rows of users deleted meanwhile are dropped. Returns the
+        number written."""
+        known = {usr for usr, in db.session.query(User.username)
+                 .filter(User.username.in_({row['username'] for row in rows}), User.deleted_at == None)}
+        rows = [dict(row, excerpt=cls.make_excerpt(row['content'])) for row in rows if row['username'] in known]
+        for start in range(0, len(rows), cls.INSERT_CHUNK):
+            db.session.execute(cls.__table__.insert().values(rows[start:start + cls.INSERT_CHUNK]))
+        counts = Counter(row['username'] for row in rows)
+        for usr, count in counts.items():
+            FeedbackSummary.record_created(usr, max(row['created_at'] for row in rows if row['username'] == usr), count)
+        db.session.commit()
+        return len(rows)
+
     # ---------Read--------------------------
     @classmethod
+    @db.replica_read
     def get_feedback_by_username(cls, usr):
-        user = User.get_user_by_username(usr)
-        if user.is_admin:
-            return cls.query.all()
+        """FeedbackRows for everything usr may see, in id order: all feedback
+        for admins. The same columns as a page, so no content is loaded."""
+        user = User.get_profile(usr)
+        if user is None:
+            return []
+        query = db.session.query(*cls.row_columns())
+        if not user.is_admin:
+            query = query.filter_by(username=usr)
+        return [FeedbackRow._make(row) for row in query.order_by(cls.id)]
+    
+    @classmethod
+    @db.replica_read
+    def get_feedback_page(cls, usr, after=None, before=None, per_page=None):
+        """Keyset page of feedback ordered by id. Pass the previous page's
+        next_cursor as `after` or its prev_cursor as `before`."""
+        per_page = per_page or db.get_app().config['FEEDBACK_PAGE_SIZE']
+        user = User.get_profile(usr)
+        if user is None:
+            return FeedbackPage([])
+        query = db.session.query(*cls.row_columns())
+        if not user.is_admin:
+            query = query.filter_by(username=usr)
+        
+        if before is not None:
+            rows = [FeedbackRow._make(row) for row in
+                    query.filter(cls.id < before).order_by(cls.id.desc()).limit(per_page + 1)]
+            has_more = len(rows) > per_page
+            items = list(reversed(rows[:per_page]))
+            has_prev, has_next = has_more, True
+        else:
+            if after is not None:
+                query = query.filter(cls.id > after)
+            rows = [FeedbackRow._make(row) for row in query.order_by(cls.id).limit(per_page + 1)]
+            items = rows[:per_page]
+            has_prev, has_next = after is not None, len(rows) > per_page
         
-        return cls.query.filter_by(username=usr).all()
+        total = None
+        if db.get_app().config['FEEDBACK_PAGE_TOTALS']:
+            total = cls.count_feedback(usr, user.is_admin)
+        return FeedbackPage(items,
+                            next_cursor=items[-1].id if items and has_next else None,
+                            prev_cursor=items[0].id if items and has_prev else None,
+                            total=total)
     
     @classmethod
-    def get_feedback_by_id(cls, id):
-        feedback = cls.query.filter_by(id=id).first()
-        return feedback
+    @db.replica_read
+    def iter_feedback(cls, usr, chunk_size=None):
+        """Every row usr may see, in id order, fetched chunk_size rows at a
+        time from a server-side cursor. For streaming, not for paging."""
+        chunk_size = chunk_size or db.get_app().config['FEEDBACK_STREAM_CHUNK']
+        user = User.get_profile(usr)
+        if user is None:
+            return iter(())
+        query = db.session.query(*cls.row_columns())
+        if not user.is_admin:
+            query = query.filter(cls.username == usr)
+        return (FeedbackRow._make(row) for row in query.order_by(cls.id).yield_per(chunk_size))
+    
+    @classmethod
+    def count_feedback(cls, usr, is_admin=False):
+        """Total for the page header, read from feedback_summary rather than
+        counted. For admins on Postgres this is the planner's estimate once
+        the table is big enough for that to matter."""
+        if is_admin:
+            if db.engine.dialect.name == 'postgresql':
+                estimate = db.session.execute(text(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = 'feedback'::regclass")).scalar()
+                if estimate is not None and estimate >= 10000:
+                    return estimate
+            return db.session.query(func.coalesce(func.sum(FeedbackSummary.feedback_count), 0)).scalar()
+        return db.session.query(FeedbackSummary.feedback_count).filter(FeedbackSummary.username == usr).scalar() or 0
+    
+    @classmethod
+    @db.replica_read
+    def search(cls, q, usr, page=1, per_page=None):
+        """Full-text search over title and content, best match first.
+        Admins search everything, other users only their own feedback.
+        The page's cursors are page numbers."""
+        per_page = per_page or db.get_app().config['FEEDBACK_PAGE_SIZE']
+        terms = q.split()
+        if not terms:
+            return FeedbackPage([])
+        query = db.session.query(*cls.row_columns()).filter(cls.owned_by(usr))
+        if db.engine.dialect.name == 'postgresql':
+            vector = literal_column('feedback.search_vector')
+            tsquery = func.plainto_tsquery('english', ' '.join(terms))
+            query = query.filter(vector.op('@@')(tsquery)).order_by(func.ts_rank(vector, tsquery).desc(), cls.id.desc())
+        else:
+            # Quote every term so FTS5 query syntax in user input is searched for, not parsed
+            match = ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+            query = (query.join(feedback_fts, feedback_fts.c.rowid == cls.id)
+                     .filter(literal_column('feedback_fts').op('MATCH')(match))
+                     .order_by(feedback_fts.c.rank, cls.id.desc()))
+        rows = [FeedbackRow._make(row) for row in query.offset((page - 1) * per_page).limit(per_page + 1)]
+        return FeedbackPage(rows[:per_page],
+                            next_cursor=page + 1 if len(rows) > per_page else None,
+                            prev_cursor=page - 1 if page > 1 else None)
+    
+    @classmethod
+    @db.replica_read
+    def get_feedback_by_id(cls, id, usr=None):
+        """With `usr`, only return the row if usr may edit it."""
+        query = cls.query.options(db.undefer('content')).filter(cls.id == id)
+        if usr is not None:
+            query = query.filter(cls.owned_by(usr))
+        return query.first()
+    
+    API_FIELDS = ('id', 'title', 'excerpt', 'content', 'username', 'created_at')
+    
+    @classmethod
+    @db.replica_read
+    def get_feedback_fields(cls, usr, fields, after=None, per_page=None):
+        """Keyset page of the rows usr may see, in id order, as dicts holding
+        only `fields` (names from API_FIELDS). Only those columns are selected."""
+        per_page = per_page or db.get_app().config['FEEDBACK_PAGE_SIZE']
+        columns = dict(zip(('id', 'title', 'excerpt', 'username'), cls.row_columns()),
+                       content=cls.content, created_at=cls.created_at)
+        user = User.get_profile(usr)
+        if user is None:
+            return FeedbackPage([])
+        query = db.session.query(cls.id, *[columns[name] for name in fields])
+        if not user.is_admin:
+            query = query.filter(cls.username == usr)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        rows = query.order_by(cls.id).limit(per_page + 1).all()
+        items = [dict(zip(fields, row[1:])) for row in rows[:per_page]]
+        return FeedbackPage(items, next_cursor=rows[per_page - 1][0] if len(rows) > per_page else None)
+    
+    @classmethod
+    def owned_by(cls, usr):
+        """SQL condition matching rows written by usr, or every row if usr is
+        an admin. Matches nothing once usr's account is deleted."""
+        active = User.active(usr)
+        return and_(active.exists(), or_(cls.username == usr, active.filter(User.is_admin == True).exists()))
     
     @classmethod
     def authenticate(cls, id, usr):
-        user = User.get_user_by_username(usr)
-        if user.is_admin:
-            return True
-        feedback = Feedback.get_feedback_by_username(usr)
-        return str(id) in [str(Feedback.id) for Feedback in feedback]
+        query = cls.query.filter(cls.id == id, cls.owned_by(usr))
+        return db.session.query(query.exists()).scalar()
         
     # ---------Update------------------------
     @classmethod
-    def update_feedback(cls, id, title, content):
-        feedback = Feedback.query.filter_by(id=id).first()
-        feedback.title = title
-        feedback.content = content
+    def update_feedback(cls, id, title, content, usr=None):
+        """Update in one statement. With `usr` the ownership check is part of
+        the WHERE clause. Returns the number of rows changed."""
+        query = cls.query.filter(cls.id == id)
+        if usr is not None:
+            query = query.filter(cls.owned_by(usr))
+        count = query.update({cls.title: title, cls.content: content, cls.excerpt: cls.make_excerpt(content)},
+                             synchronize_session=False)
+        if count:
+            FeedbackSummary.record_updated([id])
+        db.session.commit()
+        return count
+        
+    @classmethod
+    def update_many(cls, changes, usr):
+        """Apply {id: {'title': ..., 'content': ...}} changes, either field
+        optional, to the rows usr may edit. One SELECT finds those, then one
+        executemany UPDATE runs per combination of fields. Returns the ids updated."""
+        if not changes:
+            return set()
+        allowed = {id for id, in db.session.query(cls.id).filter(cls.id.in_(list(changes)), cls.owned_by(usr))}
+        groups = {}
+        for id in allowed:
+            values = dict(changes[id])
+            if 'content' in values:
+                values['excerpt'] = cls.make_excerpt(values['content'])
+            groups.setdefault(tuple(sorted(values)), []).append(
+                dict({'new_' + key: value for key, value in values.items()}, target_id=id))
+        table = cls.__table__
+        for keys, params in groups.items():
+            statement = (table.update().where(table.c.id == bindparam('target_id'))
+                         .values({key: bindparam('new_' + key) for key in keys}))
+            db.session.execute(statement, params)
+        if allowed:
+            FeedbackSummary.record_updated(allowed)
         db.session.commit()
+        return allowed
         
     # ---------Delete------------------------
     @classmethod
-    def delete_feedback(cls, id):
-        feedback = Feedback.query.filter_by(id=id).first()
-        db.session.delete(feedback)
-        db.session.commit()
\ No newline at end of file
+    def delete_feedback(cls, id, usr=None):
+        """Delete with the ownership check in the WHERE clause, see update_feedback,
+        and take the row off its owner's summary. On Postgres the DELETE returns
+        the owner, see delete_many. Returns the number of rows removed."""
+        table = cls.__table__
+        condition = table.c.id == id
+        if usr is not None:
+            condition = condition & cls.owned_by(usr)
+        if db.engine.dialect.name == 'postgresql':
+            owners = [owner for owner, in db.session.execute(table.delete().where(condition).returning(table.c.username))]
+        else:
+            owners = [owner for owner, in db.session.query(cls.username).filter(condition)]
+            if owners:
+                db.session.execute(table.delete().where(table.c.id == id))
+        if owners:
+            FeedbackSummary.record_deleted(owners[0], len(owners))
+        db.session.commit()
+        return len(owners)
+    
+    @classmethod
+    def delete_many(cls, ids, usr):
+        """Delete the rows among ids that usr may delete in one statement and
+        take them off their owners' summaries. Returns the ids deleted."""
+        if not ids:
+            return set()
+        table = cls.__table__
+        condition = (table.c.id.in_(list(ids))) & cls.owned_by(usr)
+        if db.engine.dialect.name == 'postgresql':
+            owners = dict(db.session.execute(table.delete().where(condition).returning(table.c.id, table.c.username)).fetchall())
+        else:
+            owners = dict(db.session.query(cls.id, cls.username).filter(condition))
+            if owners:
+                db.session.execute(table.delete().where(table.c.id.in_(list(owners))))
+        for owner, count in Counter(owners.values()).items():
+            FeedbackSummary.record_deleted(owner, count)
+        db.session.commit()
+        return set(owners)
+
+
+class FeedbackSummary(db.Model):
+    """
+    Feedback count and time of the newest feedback per user, kept current
+    by create_feedback and delete_feedback in the same transaction as the
+    change. Deleting a user cascades to their row. Derived data: export
+    skips it and `flask data reconcile` rebuilds it from feedback.
+
+    `version` goes up with every create, update and delete of the user's
+    feedback, in the same transaction, and never goes back: page_cache
+    keys a user's pages on it, so every worker sees a change once it commits.
+    """
+    
+    __tablename__ = 'feedback_summary'
+    __table_args__ = {'info': {'derived': True}}
+    
+    username = db.Column(db.String(20), db.ForeignKey('users.username', ondelete='CASCADE'), primary_key=True)
+    feedback_count = db.Column(db.Integer, nullable=False, default=0)
+    last_feedback_at = db.Column(db.DateTime)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    # Postgres and SQLite (3.24+) share this upsert syntax. Buffered rows can
+    # be older than the newest one counted, so the later time wins.
+    UPSERT = text("INSERT INTO feedback_summary (username, feedback_count, last_feedback_at, version) VALUES (:usr, :n, :at, 1) "
+                  "ON CONFLICT (username) DO UPDATE SET feedback_count = feedback_summary.feedback_count + excluded.feedback_count, "
+                  "version = feedback_summary.version + 1, "
+                  "last_feedback_at = CASE WHEN feedback_summary.last_feedback_at IS NULL "
+                  "OR excluded.last_feedback_at > feedback_summary.last_feedback_at "
+                  "THEN excluded.last_feedback_at ELSE feedback_summary.last_feedback_at END")
+    
+    @classmethod
+    def record_created(cls, usr, at, count=1):
+        db.session.execute(cls.UPSERT, {'usr': usr, 'n': count, 'at': at})
+    
+    @classmethod
+    def record_deleted(cls, usr, count=1):
+        if usr is None:
+            return
+        newest = (db.session.query(func.max(Feedback.created_at))
+                  .filter(Feedback.username == usr).as_scalar())
+        cls.query.filter(cls.username == usr).update(
+            {cls.feedback_count: cls.feedback_count - count, cls.last_feedback_at: newest, cls.version: cls.version + 1},
+            synchronize_session=False)
+    
+    @classmethod
+    def record_updated(cls, ids):
+        """Bump the version of whoever owns the feedback rows ids, which an
+        admin's edit may spread over several users."""
+        owners = db.session.query(Feedback.username).filter(Feedback.id.in_(list(ids)))
+        cls.query.filter(cls.username.in_(owners.subquery())).update(
+            {cls.version: cls.version + 1}, synchronize_session=False)
+    
+    @classmethod
+    def get_version(cls, usr):
+        """usr's current version, 0 before their first feedback. Read from
+        the primary, so a page cached under it is never older than a write."""
+        return db.session.query(cls.version).filter(cls.username == usr).scalar() or 0
+    
+    @classmethod
+    @db.replica_read
+    def get_summary_page(cls, after=None, before=None, per_page=None):
+        """Keyset page of users by username with their counters. Users who
+        never wrote feedback show 0. Costs one index range scan of the page."""
+        per_page = per_page or db.get_app().config['FEEDBACK_PAGE_SIZE']
+        query = (db.session.query(User.username, User.first_name, User.last_name,
+                                  func.coalesce(cls.feedback_count, 0), cls.last_feedback_at)
+                 .outerjoin(cls, cls.username == User.username)
+                 .filter(User.deleted_at == None))
+        if before is not None:
+            rows = [SummaryRow._make(row) for row in
+                    query.filter(User.username < before).order_by(User.username.desc()).limit(per_page + 1)]
+            items = list(reversed(rows[:per_page]))
+            has_prev, has_next = len(rows) > per_page, True
+        else:
+            if after is not None:
+                query = query.filter(User.username > after)
+            rows = [SummaryRow._make(row) for row in query.order_by(User.username).limit(per_page + 1)]
+            items = rows[:per_page]
+            has_prev, has_next = after is not None, len(rows) > per_page
+        return FeedbackPage(items,
+                            next_cursor=items[-1].username if items and has_next else None,
+                            prev_cursor=items[0].username if items and has_prev else None)
+    
+    @classmethod
+    def rebuild(cls, connection):
+        """Recount every user's feedback from scratch. Existing rows are
+        updated in place with their version bumped, never deleted, so no
+        version is ever handed out twice. Returns the number of users with feedback."""
+        if connection.dialect.name == 'postgresql':
+            # Creates and deletes wait for the rebuild instead of updating rows it is replacing
+            connection.execute(text("LOCK TABLE feedback_summary IN SHARE ROW EXCLUSIVE MODE"))
+        summary, feedback = cls.__table__, Feedback.__table__
+        owned = feedback.c.username == summary.c.username
+        connection.execute(summary.update().values(
+            feedback_count=db.select([func.count()]).where(owned).as_scalar(),
+            last_feedback_at=db.select([func.max(feedback.c.created_at)]).where(owned).as_scalar(),
+            version=summary.c.version + 1))
+        missing = ~db.exists().where(summary.c.username == feedback.c.username)
+        connection.execute(summary.insert().from_select(
+            ['username', 'feedback_count', 'last_feedback_at'],
+            db.select([feedback.c.username, func.count(feedback.c.id), func.max(feedback.c.created_at)])
+            .where((feedback.c.username != None) & missing).group_by(feedback.c.username)))
+        return connection.execute(db.select([func.count()]).select_from(summary)
+                                  .where(summary.c.feedback_count > 0)).scalar()
+
+
+class PendingDeletion(db.Model):
+    """
+    A deleted user whose feedback DeletionWorker is still removing, oldest
+    request first. deleted_rows is the progress so far. The row goes with
+    the user row, which is deleted once no feedback is left.
+    """
+    
+    __tablename__ = 'pending_deletions'
+    
+    username = db.Column(db.String(20), db.ForeignKey('users.username', ondelete='CASCADE'), primary_key=True)
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime)
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    
+    @classmethod
+    def purge_batch(cls, batch_size):
+        """Delete up to batch_size feedback rows of the oldest pending user,
+        or the user once they have none left, in one short transaction that
+        also updates their summary. Returns (username, rows deleted), or
+        None when nothing is pending."""
+        query = cls.query.order_by(cls.requested_at)
+        if db.engine.dialect.name == 'postgresql':
+            # Workers in other processes move on to the next user instead of waiting
+            query = query.with_for_update(skip_locked=True)
+        pending = query.first()
+        if pending is None:
+            db.session.rollback()
+            return None
+        usr = pending.username
+        feedback = Feedback.__table__
+        ids = [id for id, in db.session.query(Feedback.id).filter(Feedback.username == usr).limit(batch_size)]
+        if ids:
+            db.session.execute(feedback.delete().where(feedback.c.id.in_(ids)))
+            FeedbackSummary.record_deleted(usr, len(ids))
+            pending.deleted_rows += len(ids)
+            pending.updated_at = datetime.utcnow()
+        else:
+            # Cascades to the summary and this pending row
+            db.session.execute(User.__table__.delete().where(User.__table__.c.username == usr))
+        db.session.commit()
+        return usr, len(ids)
+
+
+# ---------Search index----------------------
+# Postgres keeps a tsvector column on feedback current with a trigger and
+# indexes it with GIN. SQLite, used for local testing, keeps an FTS5
+# table in sync with triggers instead. Neither is mapped on the model.
+feedback_fts = table('feedback_fts', column('rowid'), column('rank'))
+
+SEARCH_DDL = {
+    'postgresql': [
+        "ALTER TABLE feedback ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        "CREATE INDEX IF NOT EXISTS ix_feedback_search_vector ON feedback USING GIN (search_vector)",
+        "DROP TRIGGER IF EXISTS feedback_search_vector_update ON feedback",
+        "CREATE TRIGGER feedback_search_vector_update BEFORE INSERT OR UPDATE OF title, content ON feedback "
+        "FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', title, content)",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS feedback_fts USING fts5(title, content, content='feedback', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS feedback_fts_insert AFTER INSERT ON feedback BEGIN "
+        "INSERT INTO feedback_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS feedback_fts_delete AFTER DELETE ON feedback BEGIN "
+        "INSERT INTO feedback_fts(feedback_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS feedback_fts_update AFTER UPDATE ON feedback BEGIN "
+        "INSERT INTO feedback_fts(feedback_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); "
+        "INSERT INTO feedback_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    ],
+}
+
+SEARCH_REBUILD = {
+    'postgresql': "UPDATE feedback SET search_vector = to_tsvector('pg_catalog.english', coalesce(title, '') || ' ' || coalesce(content, ''))",
+    'sqlite': "INSERT INTO feedback_fts(feedback_fts) VALUES ('rebuild')",
+}
+
+# Finds what SEARCH_DDL creates first, on a database that has it
+SEARCH_INSTALLED = {
+    'postgresql': "SELECT 1 FROM information_schema.columns "
+                  "WHERE table_schema = current_schema() AND table_name = 'feedback' AND column_name = 'search_vector'",
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'feedback_fts'",
+}
+
+@db.event.listens_for(Feedback.__table__, 'after_create')
+def install_search(target, connection, **kw):
+    """Create the search column or table, its index and triggers. Safe to rerun."""
+    for statement in SEARCH_DDL.get(connection.dialect.name, []):
+        connection.execute(text(statement))
+
+@db.event.listens_for(Feedback.__table__, 'before_drop')
+def drop_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS feedback_fts"))
+
+def rebuild_search(connection):
+    """Install search on an existing database and index the rows already there."""
+    install_search(Feedback.__table__, connection)
+    if connection.dialect.name in SEARCH_REBUILD:
+        connection.execute(text(SEARCH_REBUILD[connection.dialect.name]))
+
+def search_installed(connection):
+    """Whether install_search has run on this database."""
+    sql = SEARCH_INSTALLED.get(connection.dialect.name)
+    return sql is None or connection.execute(text(sql)).first() is not None
+
+
+class FeedbackPage(object):
+    """One page of feedback plus the cursors for its neighbours."""
+    
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
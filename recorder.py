@@ -0,0 +1,125 @@
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from flask import g, request
+
+REDACTED = "<redacted>"
+SECRET_FIELDS = ("password", "csrf", "token", "secret")
+PERSONAL_FIELDS = ("email", "first_name", "last_name")
+
+
+def pseudonym(key, value, salt):
+    """Stand-in for a personal value: the same for the same value and salt,
+    so a replayed client stays consistent, and still a valid email address
+    where one was given."""
+    digest = hmac.new(salt, value.encode(), hashlib.sha256).hexdigest()[:12]
+    return "anon-%s@example.com" % digest if "email" in key else "anon-" + digest
+
+
+def redact(fields, salt=b""):
+    """Secrets are replaced by REDACTED, personal fields by their pseudonym.
+    Objects and lists nested in a JSON body are redacted the same way."""
+    redacted = {}
+    for key, value in fields.items():
+        name = key.lower()
+        if any(word in name for word in SECRET_FIELDS):
+            value = REDACTED
+        elif isinstance(value, (dict, list)):
+            value = redact_body(value, salt)
+        elif any(word in name for word in PERSONAL_FIELDS) and isinstance(value, str):
+            value = pseudonym(name, value, salt)
+        redacted[key] = value
+    return redacted
+
+
+def redact_body(body, salt=b""):
+    """redact for a decoded JSON body of any shape."""
+    if isinstance(body, dict):
+        return redact(body, salt)
+    if isinstance(body, list):
+        return [redact_body(item, salt) for item in body]
+    return body
+
+
+class TrafficRecorder(object):
+    """
+    Appends one JSON line per request to TRAFFIC_RECORD_PATH: when it
+    arrived, which virtual client sent it, route, method, path, query,
+    form fields and JSON body with secrets redacted and names and email addresses
+    pseudonymized (keyed on SECRET_KEY), status and timing. replay.py
+    drives the app with these traces. Off unless TRAFFIC_RECORD_PATH is set;
+    TRAFFIC_RECORD_SAMPLE records only that fraction of requests.
+
+    Clients are told apart by a random id in their own cookie, set once on
+    the first recorded response that lacks it. The Flask session is left
+    alone, so recording doesn't add Set-Cookie to every response.
+    """
+
+    SKIP_ENDPOINTS = ("static", "metrics")
+    COOKIE = "trace_client"
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._file = None
+        self.path = None
+        self.sample = 1.0
+        self.salt = b""
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRAFFIC_RECORD_PATH', None)
+        app.config.setdefault('TRAFFIC_RECORD_SAMPLE', 1.0)
+        self.path = app.config['TRAFFIC_RECORD_PATH']
+        self.sample = app.config['TRAFFIC_RECORD_SAMPLE']
+        self.salt = (app.config.get('SECRET_KEY') or "").encode()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        if self.path:
+            g.trace_start = time.time()
+
+    def _after_request(self, response):
+        start = g.get('trace_start')
+        if start is None or not self.path or request.endpoint in self.SKIP_ENDPOINTS or random.random() >= self.sample:
+            return response
+        client = request.cookies.get(self.COOKIE)
+        if not client:
+            client = uuid.uuid4().hex
+            response.set_cookie(self.COOKIE, client, httponly=True, samesite="Lax")
+        record = {
+            "ts": start,
+            "client": hashlib.sha1(client.encode()).hexdigest()[:12],
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "rule": request.url_rule.rule if request.url_rule else None,
+            "query": redact(request.args.to_dict(), self.salt),
+            "form": redact(request.form.to_dict(), self.salt),
+            "json": redact_body(request.get_json(silent=True), self.salt),
+            "status": response.status_code,
+            "ms": round((time.time() - start) * 1000, 3),
+        }
+        self.write(record)
+        return response
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+recorder = TrafficRecorder()
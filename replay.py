@@ -0,0 +1,189 @@
+"""
+Replay traces written by the traffic recorder (TRAFFIC_RECORD_PATH).
+
+Each recorded client becomes a virtual client with its own cookies whose
+requests are sent in their recorded order. Requests are released either
+at a fixed --rate (requests/sec across all clients) or on the recorded
+timeline sped up by --speed, over --concurrency worker threads.
+
+    python replay.py traffic.jsonl --target http://localhost:8000 --concurrency 16 --rate 200
+    python replay.py traffic.jsonl --in-process --speed 10
+
+JSON bodies are sent back as JSON. Redacted fields are sent as --secret, so seed the target with
+accounts that use that password. Names and email addresses were
+recorded as pseudonyms and are sent as recorded. The target needs WTF_CSRF_ENABLED off
+because recorded CSRF tokens are redacted too.
+"""
+import argparse
+import http.cookiejar
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from bench import percentile
+from recorder import REDACTED
+
+
+def unredact(value, secret):
+    """value with every REDACTED in it, however deeply nested, replaced by secret."""
+    if value == REDACTED:
+        return secret
+    if isinstance(value, dict):
+        return {k: unredact(v, secret) for k, v in value.items()}
+    if isinstance(value, list):
+        return [unredact(v, secret) for v in value]
+    return value
+
+
+def load(path, secret):
+    traces = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                trace = json.loads(line)
+                trace["form"] = unredact(trace["form"], secret)
+                trace["query"] = unredact(trace["query"], secret)
+                # Traces recorded before JSON bodies were have no "json"
+                trace["json"] = unredact(trace.get("json"), secret)
+                traces.append(trace)
+    traces.sort(key=lambda trace: trace["ts"])
+    return traces
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Redirect targets were recorded as requests of their own, so don't follow them here."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient(object):
+    def __init__(self, target):
+        self.target = target.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def send(self, trace):
+        url = self.target + trace["path"]
+        if trace["query"]:
+            url += "?" + urllib.parse.urlencode(trace["query"])
+        headers = {}
+        if trace["json"] is not None:
+            data = json.dumps(trace["json"]).encode()
+            headers["Content-Type"] = "application/json"
+        else:
+            data = urllib.parse.urlencode(trace["form"]).encode() if trace["method"] == "POST" else None
+        req = urllib.request.Request(url, data=data, headers=headers, method=trace["method"])
+        try:
+            with self.opener.open(req, timeout=30) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class InProcessClient(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, trace):
+        if trace["json"] is not None:
+            body = {"json": trace["json"]}
+        else:
+            body = {"data": trace["form"] if trace["method"] == "POST" else None}
+        resp = self.client.open(trace["path"], method=trace["method"], query_string=trace["query"], **body)
+        return resp.status_code
+
+
+def replay(traces, make_client, concurrency, rate=None, speed=1.0):
+    """Send every trace and return a list of (trace, status, seconds, error) tuples."""
+    # Pin each virtual client to one worker so its requests stay in order
+    queues = defaultdict(list)
+    workers = {}
+    for trace in traces:
+        worker = workers.setdefault(trace["client"], len(workers) % concurrency)
+        queues[worker].append(trace)
+
+    first = traces[0]["ts"] if traces else 0
+    order = {id(trace): n for n, trace in enumerate(traces)}
+    results = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def due(trace):
+        if rate:
+            return start + order[id(trace)] / float(rate)
+        return start + (trace["ts"] - first) / speed
+
+    def work(items):
+        clients = {}
+        for trace in items:
+            delay = due(trace) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client = clients.get(trace["client"])
+            if client is None:
+                client = clients[trace["client"]] = make_client()
+            sent = time.perf_counter()
+            status, error = None, None
+            try:
+                status = client.send(trace)
+            except Exception as e:
+                error = repr(e)
+            with lock:
+                results.append((trace, status, time.perf_counter() - sent, error))
+
+    threads = [threading.Thread(target=work, args=(items,)) for items in queues.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def report(results, elapsed, out=sys.stdout):
+    by_route = defaultdict(list)
+    for result in results:
+        trace = result[0]
+        by_route["%s %s" % (trace["method"], trace["rule"] or trace["path"])].append(result)
+    out.write("%d requests in %.2f s, %.1f req/s\n" % (len(results), elapsed, len(results) / max(elapsed, 1e-9)))
+    out.write("%-40s %7s %9s %9s %9s %7s %9s\n" % ("route", "count", "p50 ms", "p95 ms", "p99 ms", "errors", "mismatch"))
+    for route, items in sorted(by_route.items()):
+        times = [seconds for _, _, seconds, _ in items]
+        errors = sum(1 for _, status, _, error in items if error or (status or 0) >= 500)
+        mismatched = sum(1 for trace, status, _, _ in items if status != trace["status"])
+        out.write("%-40s %7d %9.2f %9.2f %9.2f %6.1f%% %8.1f%%\n" % (
+            route, len(items), percentile(times, 50) * 1000, percentile(times, 95) * 1000,
+            percentile(times, 99) * 1000, 100.0 * errors / len(items), 100.0 * mismatched / len(items)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target", help="base URL of a running server")
+    target.add_argument("--in-process", action="store_true", help="drive app.test_client() instead")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=None, help="requests/sec; default follows the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up applied to the recorded timing")
+    parser.add_argument("--secret", default="Password1", help="value sent for redacted fields")
+    args = parser.parse_args(argv)
+
+    traces = load(args.traces, args.secret)
+    if args.in_process:
+        from app import create_app
+        app = create_app({"WTF_CSRF_ENABLED": False})
+        make_client = lambda: InProcessClient(app)
+    else:
+        make_client = lambda: HTTPClient(args.target)
+    results, elapsed = replay(traces, make_client, args.concurrency, rate=args.rate, speed=args.speed)
+    report(results, elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+import functools
+import inspect
+import random
+import threading
+import time
+from flask import session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.engine.url import make_url
+
+# Seconds the replica is behind the primary, NULL when we can't tell. A
+# streaming standby that has replayed everything it received reports 0
+# rather than the age of the last commit. One with no WAL receiver is cut
+# off from the primary, however recently it replayed, so it is never
+# fresh. A server that is not a standby at all reports 0.
+LAG_SQL = {
+    'postgresql': "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+                  "WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN NULL "
+                  "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                  "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END",
+}
+
+
+class Replica(object):
+    """One read replica: its engine and the last lag we measured. Postgres
+    connections give up after `connect_timeout` seconds, so a replica that
+    went away costs a request that long at most."""
+
+    def __init__(self, uri, options, connect_timeout=None):
+        self.uri = uri
+        if connect_timeout and make_url(uri).get_backend_name() == 'postgresql':
+            options = dict(options, connect_args=dict(options.get('connect_args', {}), connect_timeout=connect_timeout))
+        self.engine = create_engine(uri, **options)
+        self.lag = 0.0
+        self.healthy = True
+        self.checked = None
+        self._lock = threading.Lock()
+
+    def check(self, interval, logger):
+        """Measure lag at most once every `interval` seconds. One thread
+        probes at a time; the others go on with the last measurement rather
+        than wait. A replica we can't reach, or whose lag is unknown, is
+        skipped until the next check."""
+        if self.checked is not None and time.monotonic() - self.checked < interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.checked is not None and time.monotonic() - self.checked < interval:
+                return
+            self.checked = time.monotonic()
+            sql = LAG_SQL.get(self.engine.dialect.name)
+            try:
+                if sql:
+                    with self.engine.connect() as connection:
+                        lag = connection.execute(text(sql)).scalar()
+                    self.lag = float('inf') if lag is None else float(lag)
+                self.healthy = True
+            except Exception:
+                logger.warning("replica %s unavailable", self.engine.url, exc_info=True)
+                self.healthy = False
+        finally:
+            self._lock.release()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends queries made inside a `replica_read` function to a
+    replica. Once the session has flushed or committed it is pinned to the
+    primary for the rest of the request, so a request reads its own writes.
+    `read_replica` records whether any query went to a replica.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.use_replica = False
+        self.pinned = False
+        self.wrote = False
+        self.read_replica = False
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and not self.pinned and not self._flushing:
+            engine = self.db.replica_engine()
+            if engine is not None:
+                self.read_replica = True
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+@event.listens_for(RoutingSession, 'after_commit')
+def _pin_after_write(session, *args):
+    session.pinned = session.wrote = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with optional read replicas, listed in SQLALCHEMY_REPLICA_URIS
+    and used when READ_REPLICAS_ENABLED is set. Reads go to a random replica
+    whose lag is within REPLICA_MAX_LAG seconds, and to the primary when
+    none is. A client that wrote stays on the primary for
+    REPLICA_PIN_SECONDS afterwards, so its next page shows its change.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = {}
+        self._replica_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('READ_REPLICAS_ENABLED', False)
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_MAX_LAG', 5.0)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 5.0)
+        app.config.setdefault('REPLICA_PIN_SECONDS', 5)
+        app.config.setdefault('REPLICA_CONNECT_TIMEOUT', 2)
+        super().init_app(app)
+        app.before_request(self._pin_from_cookie)
+        app.after_request(self._remember_write)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_read(self, fn):
+        """Decorator for functions that only read. Their queries may go to a
+        replica; generators keep doing so as they are iterated."""
+        def on_replica(call):
+            session = self.session()
+            previous = session.use_replica
+            session.use_replica = True
+            try:
+                return call()
+            finally:
+                session.use_replica = previous
+
+        def iterate(gen):
+            while True:
+                try:
+                    yield on_replica(functools.partial(next, gen))
+                except StopIteration:
+                    return
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            result = on_replica(functools.partial(fn, *args, **kwargs))
+            return iterate(result) if inspect.isgenerator(result) else result
+        return wrapper
+
+    def primary_read(self, fn):
+        """Decorator for reads whose results are cached across requests.
+        Their queries go to the primary even when called from a replica_read
+        function, so a lagging replica's rows are never cached."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = self.session()
+            previous = session.use_replica
+            session.use_replica = False
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                session.use_replica = previous
+        return wrapper
+
+    def read_replica(self):
+        """True once this request's session has sent a query to a replica,
+        so what it rendered may be stale and must not be cached."""
+        return self.session.registry.has() and self.session().read_replica
+
+    def replica_engine(self):
+        """Engine of a usable replica, or None to read from the primary."""
+        app = self.get_app()
+        config = app.config
+        if not config['READ_REPLICAS_ENABLED']:
+            return None
+        usable = []
+        for uri in config['SQLALCHEMY_REPLICA_URIS']:
+            replica = self._replica(uri, config)
+            replica.check(config['REPLICA_LAG_CHECK_INTERVAL'], app.logger)
+            if replica.healthy and replica.lag <= config['REPLICA_MAX_LAG']:
+                usable.append(replica)
+        return random.choice(usable).engine if usable else None
+
+    def _replica(self, uri, config):
+        replica = self._replicas.get(uri)
+        if replica is None:
+            with self._replica_lock:
+                replica = self._replicas.get(uri)
+                if replica is None:
+                    replica = self._replicas[uri] = Replica(uri, config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+                                                              config['REPLICA_CONNECT_TIMEOUT'])
+        return replica
+
+    def replicas(self):
+        return list(self._replicas.values())
+
+    def dispose_replicas(self):
+        """Close replica connections and forget the engines."""
+        with self._replica_lock:
+            for replica in self._replicas.values():
+                replica.engine.dispose()
+            self._replicas.clear()
+
+    # ---------Read your writes--------------
+    def _pin_from_cookie(self):
+        if not self.get_app().config['READ_REPLICAS_ENABLED']:
+            return
+        if cookie_session.get('_primary_until', 0) > time.time():
+            self.session().pinned = True
+
+    def _remember_write(self, response):
+        config = self.get_app().config
+        if config['READ_REPLICAS_ENABLED'] and self.session.registry.has() and self.session().wrote:
+            cookie_session['_primary_until'] = int(time.time() + config['REPLICA_PIN_SECONDS'])
+        return response
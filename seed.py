@@ -1,5 +1,8 @@
 from models import db
-from app import app
+from app import create_app
 
-db.drop_all()
-db.create_all()
\ No newline at end of file
+app = create_app()
+
+with app.app_context():
+    db.drop_all()
+    db.create_all()
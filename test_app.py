@@ -1,23 +1,35 @@
-from unittest import TestCase
-from app import app
-from models import db, User, Feedback
+from app import create_app
+from testing import TEST_CONFIG, TransactionalTestCase, committing, get_app
+from models import db, hasher, User, Feedback, user_cache, page_cache
+from metrics import metrics
 from forms import LoginForm, RegisterForm, FeedbackForm
 from flask import session
-app.config['SQLALCHEMY_DATATBASE_URI'] = 'postgresql:///feedback_test'
-app.config['SQLALCHEMY_ECHO'] = False
+import gzip
+import json
+import re
+import shutil
+import os
+import tempfile
+import replay
+from recorder import REDACTED, recorder, redact, redact_body
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from admission import admission, TimedQueuePool
+from buffer import feedback_buffer
+from routing import Replica
+from assets import assets, brotli
+import time
+app = get_app()
 
+METRICS_AUTH = {"Authorization": "Bearer " + TEST_CONFIG['METRICS_TOKEN']}
 
 
-db.drop_all()
-db.create_all()
-
-class AppTestCase(TestCase):
+class AppTestCase(TransactionalTestCase):
     """
     Note: models.py unittest has been conducted and all passed. Use model.py functions for simplicity.
     """
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
+        super().setUp()
         """Create Mock data"""
         self.mockLoginForm = {"username": "TestUsername1", "password": "Password1"}
         
@@ -25,10 +37,6 @@ class AppTestCase(TestCase):
         
         self.mockFeedbackForm = {"title": "TestTitle", "content": "TestContent"}
         
-        """Clean up any unwanted data"""
-        User.query.delete()
-        Feedback.query.delete()
-        
         """Create a user for testing"""
         user = User.register_user("TestUsername1","Password1", "Test@test.com", "TestFirstname", "TestLastname")
         self.username = user.username
@@ -110,6 +118,660 @@ class AppTestCase(TestCase):
             """Clean up logout"""
             client.get("/logout")
             
+    def test_secret_pagination(self):
+        with app.test_client() as client:
+            app.config['FEEDBACK_PAGE_SIZE'] = 2
+            for i in range(3):
+                Feedback.create_feedback(f"PagedTitle{i}", "PagedContent", self.username)
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.get(f"/users/{self.username}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("4 total", html)
+            self.assertIn("PagedTitle0", html)
+            self.assertNotIn("PagedTitle1", html)
+            self.assertIn("?after=", html)
+
+            """Follow the next cursor"""
+            page = Feedback.get_feedback_page(self.username)
+            resp = client.get(f"/users/{self.username}?after={page.next_cursor}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("PagedTitle1", html)
+            self.assertIn("PagedTitle2", html)
+            self.assertIn("?before=", html)
+            self.assertNotIn("?after=", html)
+
+            """Clean up logout"""
+            app.config['FEEDBACK_PAGE_SIZE'] = 20
+            client.get("/logout")
+
+    def test_secret_stream_all(self):
+        with app.test_client() as client:
+            for i in range(5):
+                Feedback.create_feedback(f"StreamedTitle{i}", "StreamedContent", self.username)
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.get(f"/users/{self.username}?all=1")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+            self.assertIn('<h1 class="display-4">Welcome', html)
+            for i in range(5):
+                self.assertIn(f"StreamedTitle{i}", html)
+            self.assertNotIn("?after=", html)
+
+            """Clean up logout"""
+            client.get("/logout")
+
+    def test_secret_user_cache(self):
+        with app.test_client() as client:
+            client.post("/login", data=self.mockLoginForm)
+            client.get(f"/users/{self.username}")
+            before = user_cache.stats()
+            resp = client.get(f"/users/{self.username}")
+            after = user_cache.stats()
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(after["misses"], before["misses"])
+            self.assertEqual(after["hits"], before["hits"] + 1)
+
+            """Changing the user drops the cached profile"""
+            user = User.get_user_by_username(self.username)
+            user.first_name = "ChangedFirstname"
+            db.session.commit()
+            resp = client.get(f"/users/{self.username}")
+            self.assertIn("ChangedFirstname", resp.get_data(as_text=True))
+
+            """Admin rights and deletion take effect at once, even when made outside the ORM"""
+            self.assertEqual(client.get("/admin/summary").status_code, 401)
+            User.query.filter_by(username=self.username).update({User.is_admin: True}, synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(client.get("/admin/summary").status_code, 200)
+            User.query.filter_by(username=self.username).update({User.deleted_at: db.func.now()}, synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(client.get(f"/users/{self.username}").status_code, 302)
+            self.assertIsNotNone(user_cache.get(self.username))
+            with client.session_transaction() as sess:
+                self.assertNotIn("user_id", sess)
+
+    def test_secret_page_cache(self):
+        with app.test_client() as client:
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.get(f"/users/{self.username}")
+            etag = resp.headers["ETag"]
+
+            """A repeat visit only checks the user's access and version, a revalidation gets 304"""
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.get(f"/users/{self.username}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers["ETag"], etag)
+                resp = client.get(f"/users/{self.username}", headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 304)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertEqual([s for s in statements if re.search(r"\bfeedback\b", s)], [])
+
+            """New feedback changes the page"""
+            Feedback.create_feedback("FreshTitle", "FreshContent", self.username)
+            resp = client.get(f"/users/{self.username}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("FreshTitle", resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            """So does an edit made elsewhere, for example by an admin, once it commits"""
+            etag = resp.headers["ETag"]
+            Feedback.update_feedback(self.feedback_id, "EditedTitle", "EditedContent")
+            resp = client.get(f"/users/{self.username}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("EditedTitle", resp.get_data(as_text=True))
+
+            """Clean up logout"""
+            client.get("/logout")
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.post("/login", data=self.mockLoginForm)
+            client.get(f"/users/{self.username}")
+            resp = client.get("/metrics", headers=METRICS_AUTH)
+            text = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('http_request_duration_seconds_count{endpoint="views.secret"}', text)
+            self.assertIn('db_queries_total{endpoint="views.secret"}', text)
+            self.assertIn('user_cache_hits_total', text)
+
+            """Scrapes need the token"""
+            self.assertEqual(client.get("/metrics").status_code, 401)
+            self.assertEqual(client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 401)
+
+            """Clean up logout"""
+            client.get("/logout")
+
+        """Queries a streamed page makes while it is sent count toward its route"""
+        client = app.test_client()
+        client.post("/login", data=self.mockLoginForm)
+        before = metrics.routes["views.secret"]["queries"]
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        app.config['TEMPLATE_STREAM_BUFFER'] = 2
+        try:
+            resp = client.get(f"/users/{self.username}?all=1")
+            self.assertIn("TestFeedback1", resp.get_data(as_text=True))
+            resp.close()
+        finally:
+            app.config['TEMPLATE_STREAM_BUFFER'] = TEST_CONFIG.get('TEMPLATE_STREAM_BUFFER', 50)
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(metrics.routes["views.secret"]["queries"] - before, len(statements))
+
+        """A statement that fails leaves no timer behind on its connection"""
+        connection = db.session.connection()
+        with self.assertRaises(Exception):
+            connection.execute("SELECT * FROM no_such_table")
+        self.assertEqual(connection.info.get("query_start"), [])
+
+    def test_search_feedback(self):
+        with app.test_client() as client:
+            Feedback.create_feedback("Slow checkout", "The checkout page takes forever", self.username)
+            Feedback.create_feedback("Colors", "Please add a dark theme", self.username)
+            User.register_user("OtherUser", "OtherPassword", "Other@test.com", "OtherFirst", "OtherLast")
+            Feedback.create_feedback("Other checkout", "checkout from someone else", "OtherUser")
+
+            """Test while not logged in"""
+            resp = client.get("/feedback/search?q=checkout")
+            self.assertEqual(resp.status_code, 302)
+
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.get("/feedback/search?q=checkout")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Slow checkout", html)
+            self.assertNotIn("Colors", html)
+            self.assertNotIn("Other checkout", html)
+
+            """Query syntax in the search box is treated as text"""
+            resp = client.get('/feedback/search?q="dark AND NOT*')
+            self.assertEqual(resp.status_code, 200)
+
+            """Clean up logout"""
+            client.get("/logout")
+
+    @committing
+    def test_record_and_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            recorder.path = os.path.join(tmp, "traffic.jsonl")
+            try:
+                with app.test_client() as client:
+                    client.post("/login", data=self.mockLoginForm)
+                    client.get(f"/users/{self.username}")
+                    client.patch("/api/feedback", json={"items": [{"id": self.feedback_id, "title": "Recorded"}]})
+                    client.get("/metrics", headers=METRICS_AUTH)
+                    client.get("/logout")
+            finally:
+                recorder.close()
+                recorder.path = None
+            traces = replay.load(os.path.join(tmp, "traffic.jsonl"), "Password1")
+
+            """Recording leaves the session alone: a visitor gets the trace cookie once"""
+            recorder.path = os.path.join(tmp, "anonymous.jsonl")
+            try:
+                with app.test_client() as client:
+                    resp = client.get("/login")
+                    self.assertEqual([cookie.split("=")[0] for cookie in resp.headers.getlist("Set-Cookie")],
+                                     ["trace_client"])
+                    self.assertEqual(client.get("/login").headers.getlist("Set-Cookie"), [])
+            finally:
+                recorder.close()
+                recorder.path = None
+
+        self.assertEqual([t["endpoint"] for t in traces],
+                         ["views.login", "views.secret", "api.update_feedback", "views.logout"])
+        self.assertEqual(len({t["client"] for t in traces}), 1)
+        self.assertEqual(traces[0]["form"]["password"], "Password1")
+
+        """Personal fields are recorded as stable pseudonyms"""
+        fields = redact({"username": "u", "email": "Test@test.com", "first_name": "Test", "csrf_token": "t"}, b"k")
+        self.assertEqual(fields["username"], "u")
+        self.assertEqual(fields["csrf_token"], REDACTED)
+        self.assertNotIn("Test", fields["email"] + fields["first_name"])
+        self.assertTrue(fields["email"].endswith("@example.com"))
+        self.assertEqual(redact({"email": "Test@test.com"}, b"k"), {"email": fields["email"]})
+        self.assertEqual(redact_body({"users": [{"email": "Test@test.com", "password": "p"}]}, b"k"),
+                         {"users": [{"email": fields["email"], "password": REDACTED}]})
+        self.assertEqual(traces[1]["status"], 200)
+        self.assertEqual(traces[2]["json"], {"items": [{"id": self.feedback_id, "title": "Recorded"}]})
+
+        """Replay sends JSON bodies back as JSON"""
+        Feedback.update_feedback(self.feedback_id, "Changed", "Content")
+        results, elapsed = replay.replay(traces, lambda: replay.InProcessClient(app), concurrency=2, rate=1000)
+        self.assertEqual([status for _, status, _, _ in results], [302, 200, 200, 302])
+        self.assertEqual(Feedback.get_feedback_by_id(self.feedback_id).title, "Recorded")
+
+    @committing
+    def test_data_export_import(self):
+        Feedback.create_feedback("ExportTitle", "Content with \"quotes\", commas\nand newlines", self.username)
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dump.jsonl")
+            result = runner.invoke(args=["data", "export", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([line["table"] for line in lines], ["users", "feedback", "feedback"])
+
+            Feedback.query.delete()
+            User.query.delete()
+            db.session.commit()
+            result = runner.invoke(args=["data", "import", path, "--batch-size", "1"])
+            self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Feedback.query.count(), 2)
+        self.assertEqual(Feedback.query.filter_by(title="ExportTitle").one().content,
+                         "Content with \"quotes\", commas\nand newlines")
+
+    def test_data_upgrade(self):
+        """An existing database gets the tables and columns added since it was created"""
+        with tempfile.TemporaryDirectory() as tmp:
+            other = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(tmp, "old.db")))
+            try:
+                with other.app_context():
+                    db.create_all()
+                    db.engine.execute("ALTER TABLE feedback DROP COLUMN excerpt")
+                    db.engine.execute("DROP INDEX ix_feedback_username_created_at")
+                    db.engine.execute("ALTER TABLE feedback DROP COLUMN created_at")
+                    db.engine.execute("DROP TABLE feedback_summary")
+                    for trigger in ("insert", "delete", "update"):
+                        db.engine.execute("DROP TRIGGER feedback_fts_%s" % trigger)
+                    db.engine.execute("DROP TABLE feedback_fts")
+                    db.engine.execute("INSERT INTO users (username, password, email, first_name, last_name) "
+                                      "VALUES ('old', 'x', 'old@test.com', 'Old', 'User')")
+                    db.engine.execute("INSERT INTO feedback (title, content, username) VALUES ('Old', 'Old content', 'old')")
+                    runner = other.test_cli_runner()
+                    result = runner.invoke(args=["data", "upgrade"])
+                    self.assertEqual(result.exit_code, 0, result.output)
+                    self.assertIn("added feedback.excerpt", result.output)
+                    self.assertIn("added feedback.created_at", result.output)
+                    self.assertIn("created feedback_summary", result.output)
+                    self.assertIn("search index built", result.output)
+                    columns = [column["name"] for column in inspect(db.engine).get_columns("feedback")]
+                    self.assertIn("excerpt", columns)
+                    self.assertIn("created_at", columns)
+                    self.assertEqual(db.engine.execute("SELECT username, feedback_count FROM feedback_summary").fetchall(),
+                                     [("old", 1)])
+                    rows = db.engine.execute(db.session.query(*Feedback.row_columns()).statement)
+                    self.assertEqual([row.excerpt for row in rows], ["Old content"])
+                    self.assertEqual(db.engine.execute("SELECT count(*) FROM feedback_fts WHERE feedback_fts MATCH 'content'")
+                                     .scalar(), 1)
+
+                    """Running it again changes nothing"""
+                    result = runner.invoke(args=["data", "upgrade"])
+                    self.assertEqual(result.exit_code, 0, result.output)
+                    self.assertNotIn("added", result.output)
+                    self.assertNotIn("created", result.output)
+                    self.assertNotIn("search", result.output)
+            finally:
+                db.app = app
+
+    def test_read_replica_routing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            uri = "sqlite:///" + os.path.join(tmp, "replica.db")
+            replica = create_engine(uri)
+            db.metadata.create_all(replica)
+            replica.execute(User.__table__.insert(), username=self.username, password="x", email="Test@test.com",
+                            first_name="ReplicaFirstname", last_name="TestLastname")
+            replica.execute(Feedback.__table__.insert(), id=self.feedback_id, title="ReplicaTitle",
+                            content="ReplicaContent", username=self.username)
+            replica.dispose()
+            app.config['SQLALCHEMY_REPLICA_URIS'] = [uri]
+            app.config['READ_REPLICAS_ENABLED'] = True
+            db.session.remove()
+            try:
+                """Reads go to the replica until the session writes"""
+                self.assertEqual(Feedback.get_feedback_by_id(self.feedback_id).title, "ReplicaTitle")
+                self.assertEqual(Feedback.update_feedback(self.feedback_id, "PrimaryTitle", "PrimaryContent"), 1)
+                self.assertEqual(Feedback.get_feedback_by_id(self.feedback_id).title, "PrimaryTitle")
+                db.session.remove()
+
+                with app.test_client() as client:
+                    client.post("/login", data=self.mockLoginForm)
+                    resp = client.get(f"/feedback/{self.feedback_id}/update")
+                    self.assertIn("ReplicaTitle", resp.get_data(as_text=True))
+
+                    """A client that wrote reads from the primary on its next request"""
+                    client.post(f"/users/{self.username}/feedback/add", data=self.mockFeedbackForm)
+                    resp = client.get(f"/feedback/{self.feedback_id}/update")
+                    self.assertIn("PrimaryTitle", resp.get_data(as_text=True))
+                    client.get("/logout")
+
+                """Profiles and pages read from a replica are not cached"""
+                with app.test_client() as client:
+                    client.post("/login", data=self.mockLoginForm)
+                    user_cache.clear()
+                    html = client.get(f"/users/{self.username}").get_data(as_text=True)
+                    self.assertIn("ReplicaTitle", html)
+                    self.assertIn("TestFirstname", html)
+                    self.assertEqual(user_cache.get(self.username).first_name, "TestFirstname")
+                    self.assertEqual(page_cache.stats()["size"], 0)
+                    client.get("/logout")
+
+                """A replica further behind than REPLICA_MAX_LAG is skipped"""
+                app.config['REPLICA_MAX_LAG'] = -1
+                with app.test_client() as client:
+                    client.post("/login", data=self.mockLoginForm)
+                    resp = client.get(f"/feedback/{self.feedback_id}/update")
+                    self.assertIn("PrimaryTitle", resp.get_data(as_text=True))
+                    client.get("/logout")
+            finally:
+                app.config['READ_REPLICAS_ENABLED'] = False
+                app.config['SQLALCHEMY_REPLICA_URIS'] = []
+                app.config['REPLICA_MAX_LAG'] = 5.0
+                db.session.remove()
+                db.dispose_replicas()
+
+    def test_replica_check(self):
+        replica = Replica("sqlite://", {}, 2)
+        try:
+            """A probe already running elsewhere is not repeated or waited for"""
+            with replica._lock:
+                replica.check(0, app.logger)
+            self.assertIsNone(replica.checked)
+            replica.check(0, app.logger)
+            self.assertIsNotNone(replica.checked)
+            self.assertTrue(replica.healthy)
+        finally:
+            replica.engine.dispose()
+
+    def test_admission_control(self):
+        with app.test_client() as client:
+            """Past the in-flight limit requests are shed, /metrics still answers"""
+            admission.max_in_flight = 1
+            admission.in_flight += 1
+            try:
+                resp = client.get("/login")
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "1")
+                self.assertEqual(client.get("/metrics", headers=METRICS_AUTH).status_code, 200)
+            finally:
+                admission.in_flight -= 1
+                admission.max_in_flight = 0
+            self.assertEqual(client.get("/login").status_code, 200)
+
+            """A saturated pool whose checkouts have been slow sheds load"""
+            engine = create_engine("sqlite://", poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.2)
+            admission.watch_pool(lambda: engine.pool)
+            admission.max_pool_wait = 0.02
+            try:
+                held = engine.connect()
+                with self.assertRaises(PoolTimeout):
+                    engine.connect()
+                self.assertTrue(engine.pool.saturated())
+                self.assertEqual(client.get("/login").status_code, 503)
+                held.close()
+                self.assertEqual(client.get("/login").status_code, 200)
+            finally:
+                admission.watch_pool(lambda: db.engine.pool)
+                admission.max_pool_wait = 0.5
+                engine.dispose()
+        self.assertEqual(admission.in_flight, 0)
+
+    def test_hashing_busy(self):
+        """With every bcrypt slot taken, logins get a 503 instead of waiting"""
+        slots = hasher.pool_size + hasher.queue_depth
+        for _ in range(slots):
+            hasher._slots.acquire()
+        hasher.queue_timeout, admission.retry_after = 0.01, 7
+        try:
+            with app.test_client() as client:
+                resp = client.post("/login", data=self.mockLoginForm)
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "7")
+        finally:
+            for _ in range(slots):
+                hasher._slots.release()
+            hasher.queue_timeout = app.config["BCRYPT_QUEUE_TIMEOUT"]
+            admission.retry_after = app.config["ADMISSION_RETRY_AFTER"]
+        with app.test_client() as client:
+            self.assertEqual(client.post("/login", data=self.mockLoginForm).status_code, 302)
+
+    def test_create_app(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            other = create_app(dict(TEST_CONFIG, TEMPLATE_CACHE_DIR=tmp, FEEDBACK_PAGE_SIZE=7,
+                                    SQLALCHEMY_DATABASE_URI=app.config["SQLALCHEMY_DATABASE_URI"]))
+            try:
+                self.assertEqual(other.config["FEEDBACK_PAGE_SIZE"], 7)
+                self.assertIn("views.secret", other.view_functions)
+
+                """Rendering stores compiled templates in the bytecode cache"""
+                with other.test_client() as client:
+                    resp = client.get("/login")
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertTrue(os.listdir(tmp))
+                    text = client.get("/metrics", headers=METRICS_AUTH).get_data(as_text=True)
+                    self.assertIn("app_startup_seconds", text)
+            finally:
+                db.app = app
+
+        """By default Jinja's own per-user directory holds the cache, private to this user"""
+        directory = app.jinja_env.bytecode_cache.directory
+        self.assertEqual(os.stat(directory).st_uid, os.getuid())
+        self.assertEqual(os.stat(directory).st_mode & 0o077, 0)
+
+    @committing
+    def test_admin_summary(self):
+        with app.test_client() as client:
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.get("/admin/summary")
+            self.assertEqual(resp.status_code, 401)
+
+            user = User.get_user_by_username(self.username)
+            user.is_admin = True
+            db.session.commit()
+            Feedback.create_feedback("Second", "Content", self.username)
+            resp = client.get("/admin/summary")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<td>TestUsername1</td>", html)
+            self.assertIn("<td>2</td>", html)
+
+            """Reconcile recounts from feedback"""
+            db.session.execute("UPDATE feedback_summary SET feedback_count = 99")
+            db.session.commit()
+            result = app.test_cli_runner().invoke(args=["data", "reconcile"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("<td>2</td>", client.get("/admin/summary").get_data(as_text=True))
+
+            """Clean up logout"""
+            client.get("/logout")
+
+    def test_feedback_api(self):
+        with app.test_client() as client:
+            """Test while not logged in"""
+            resp = client.get("/api/feedback")
+            self.assertEqual(resp.status_code, 401)
+
+            client.post("/login", data=self.mockLoginForm)
+            resp = client.post("/api/feedback", json={"items": [
+                {"title": "ApiTitle1", "content": "ApiContent1"},
+                {"title": "", "content": "No title"},
+                {"title": "ApiTitle2", "content": "ApiContent2"},
+            ]})
+            results = resp.get_json()["results"]
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([r["status"] for r in results], ["created", "invalid", "created"])
+            self.assertIn("title", results[1]["errors"])
+            first, second = results[0]["id"], results[2]["id"]
+            self.assertEqual(Feedback.get_feedback_page(self.username).total, 3)
+
+            """Reads return only the fields asked for"""
+            resp = client.get("/api/feedback?fields=id,title&limit=2")
+            body = resp.get_json()
+            self.assertEqual(body["items"], [{"id": self.feedback_id, "title": "TestFeedback1"},
+                                             {"id": first, "title": "ApiTitle1"}])
+            resp = client.get(f"/api/feedback?fields=content&after={body['next']}")
+            self.assertEqual(resp.get_json(), {"items": [{"content": "ApiContent2"}], "next": None})
+            self.assertEqual(client.get("/api/feedback?fields=password").status_code, 400)
+
+            """Updates and deletes report rows the user can't touch as not_found"""
+            User.register_user("OtherUser", "OtherPassword", "Other@test.com", "OtherFirst", "OtherLast")
+            other = Feedback.create_feedback("OtherTitle", "OtherContent", "OtherUser").id
+            resp = client.patch("/api/feedback", json={"items": [
+                {"id": first, "title": "PatchedTitle"},
+                {"id": second, "content": "PatchedContent"},
+                {"id": other, "title": "Hijacked"},
+            ]})
+            self.assertEqual([r["status"] for r in resp.get_json()["results"]], ["updated", "updated", "not_found"])
+            self.assertEqual(Feedback.get_feedback_by_id(first).title, "PatchedTitle")
+            self.assertEqual(Feedback.get_feedback_by_id(second).content, "PatchedContent")
+            self.assertEqual(Feedback.get_feedback_by_id(other).title, "OtherTitle")
+
+            resp = client.delete("/api/feedback", json={"ids": [first, other]})
+            self.assertEqual([r["status"] for r in resp.get_json()["results"]], ["deleted", "not_found"])
+            self.assertIsNone(Feedback.get_feedback_by_id(first))
+            self.assertEqual(Feedback.get_feedback_page(self.username).total, 2)
+
+            """true and false are not ids"""
+            resp = client.patch("/api/feedback", json={"items": [{"id": True, "title": "BoolTitle"}]})
+            self.assertEqual([r["status"] for r in resp.get_json()["results"]], ["invalid"])
+            self.assertEqual(client.delete("/api/feedback", json={"ids": [False]}).status_code, 400)
+
+            """Batches are capped"""
+            app.config['API_MAX_BATCH'] = 1
+            try:
+                resp = client.delete("/api/feedback", json={"ids": [first, second]})
+                self.assertEqual(resp.status_code, 413)
+            finally:
+                app.config['API_MAX_BATCH'] = 100
+
+            """Clean up logout"""
+            client.get("/logout")
+
+    @committing
+    def test_feedback_buffer(self):
+        app.config.update(FEEDBACK_BUFFER_ENABLED=True, FEEDBACK_BUFFER_MAX_DELAY=60)
+        try:
+            with app.test_client() as client:
+                """Submissions are acknowledged before they are written"""
+                client.post("/login", data=self.mockLoginForm)
+                resp = client.post(f"/users/{self.username}/feedback/add", data=self.mockFeedbackForm, follow_redirects=True)
+                self.assertIn("Your feedback will show up in a moment", resp.get_data(as_text=True))
+                self.assertEqual(Feedback.get_feedback_page(self.username).total, 1)
+                self.assertEqual(feedback_buffer.pending(), 1)
+
+                """A flush writes the queue in one go; rows of missing users are skipped"""
+                self.assertTrue(feedback_buffer.add("Ghost", "Nobody", "NoSuchUser"))
+                skipped = feedback_buffer.skipped
+                self.assertEqual(feedback_buffer.flush(), 1)
+                self.assertEqual(feedback_buffer.skipped, skipped + 1)
+                self.assertEqual(feedback_buffer.pending(), 0)
+                self.assertEqual(Feedback.get_feedback_page(self.username).total, 2)
+                self.assertEqual(Feedback.count_feedback(self.username), 2)
+                self.assertIn("TestTitle", client.get(f"/users/{self.username}").get_data(as_text=True))
+                self.assertIn("feedback_buffer_skipped_total", client.get("/metrics", headers=METRICS_AUTH).get_data(as_text=True))
+
+                """Reaching the size threshold wakes the flusher"""
+                app.config['FEEDBACK_BUFFER_MAX_ROWS'] = 1
+                # End this session's read transaction, which would hold the flusher's write back
+                db.session.rollback()
+                feedback_buffer.add("Buffered", "Written by the flusher", self.username)
+                deadline = time.time() + 5
+                while feedback_buffer.pending() and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(feedback_buffer.pending(), 0)
+                self.assertEqual(Feedback.get_feedback_page(self.username).total, 3)
+
+                """A batch that keeps failing is written row by row and the bad row dropped"""
+                app.config.update(FEEDBACK_BUFFER_MAX_ROWS=500, FEEDBACK_BUFFER_MAX_RETRIES=1)
+                feedback_buffer.add("Bad", None, self.username)
+                feedback_buffer.add("Good", "Queued behind a bad row", self.username)
+                dropped = feedback_buffer.dropped
+                with self.assertRaises(Exception):
+                    feedback_buffer.flush()
+                self.assertEqual(feedback_buffer.pending(), 2)
+                self.assertEqual(feedback_buffer.flush(), 1)
+                self.assertEqual(feedback_buffer.dropped, dropped + 1)
+                self.assertEqual(feedback_buffer.pending(), 0)
+                db.session.rollback()
+                self.assertEqual(Feedback.get_feedback_page(self.username).total, 4)
+
+                """A full queue sends writers back to the database"""
+                app.config['FEEDBACK_BUFFER_MAX_PENDING'] = 0
+                self.assertFalse(feedback_buffer.add("Direct", "Direct", self.username))
+                client.get("/logout")
+        finally:
+            app.config.update(FEEDBACK_BUFFER_ENABLED=False, FEEDBACK_BUFFER_MAX_ROWS=500,
+                              FEEDBACK_BUFFER_MAX_DELAY=1.0, FEEDBACK_BUFFER_MAX_PENDING=10000,
+                              FEEDBACK_BUFFER_MAX_RETRIES=3)
+            feedback_buffer.flush()
+
+    def test_static_assets(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            static = app.static_folder
+            shutil.copy(os.path.join(static, "app.css"), tmp)
+            app.static_folder = tmp
+            try:
+                result = app.test_cli_runner().invoke(args=["assets", "build"])
+                self.assertEqual(result.exit_code, 0, result.output)
+                with open(os.path.join(tmp, "dist", "manifest.json")) as f:
+                    built = json.load(f)["app.css"]
+                self.assertRegex(built, r"^app\.[0-9a-f]{12}\.css$")
+
+                with app.test_client() as client:
+                    """Pages link the fingerprinted name"""
+                    self.assertIn(f'href="/static/dist/{built}"', client.get("/login").get_data(as_text=True))
+
+                    """Which is cached for good and sent precompressed when accepted"""
+                    with open(os.path.join(static, "app.css"), "rb") as f:
+                        css = f.read()
+                    resp = client.get(f"/static/dist/{built}")
+                    self.assertEqual(resp.data, css)
+                    self.assertIn("immutable", resp.headers["Cache-Control"])
+                    self.assertEqual(resp.mimetype, "text/css")
+                    resp.close()
+                    resp = client.get(f"/static/dist/{built}", headers={"Accept-Encoding": "gzip"})
+                    self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                    self.assertEqual(gzip.decompress(resp.data), css)
+                    self.assertIn("Accept-Encoding", resp.headers["Vary"])
+                    resp.close()
+                    if brotli is not None:
+                        resp = client.get(f"/static/dist/{built}", headers={"Accept-Encoding": "gzip, br"})
+                        self.assertEqual(resp.headers["Content-Encoding"], "br")
+                        self.assertEqual(brotli.decompress(resp.data), css)
+                        resp.close()
+            finally:
+                app.static_folder = static
+                assets.load(app)
+
+    def test_compressed_html(self):
+        with app.test_client() as client:
+            client.post("/login", data=self.mockLoginForm)
+            plain = client.get(f"/users/{self.username}")
+            self.assertNotIn("Content-Encoding", plain.headers)
+
+            """HTML over the threshold is compressed, under its own ETag"""
+            app.config['COMPRESS_MIN_SIZE'] = 100
+            try:
+                resp = client.get(f"/users/{self.username}", headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertEqual(gzip.decompress(resp.data), plain.data)
+                self.assertIn("Accept-Encoding", resp.headers["Vary"])
+                self.assertEqual(resp.headers["ETag"], plain.headers["ETag"][:-1] + '-gzip"')
+
+                """Which revalidates to a 304"""
+                resp = client.get(f"/users/{self.username}",
+                                  headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+                self.assertEqual(resp.status_code, 304)
+                self.assertNotIn("Content-Encoding", resp.headers)
+
+                """Streamed pages and small pages are sent as they are"""
+                resp = client.get(f"/users/{self.username}?all=1", headers={"Accept-Encoding": "gzip"})
+                self.assertNotIn("Content-Encoding", resp.headers)
+                app.config['COMPRESS_MIN_SIZE'] = len(plain.data) + 1
+                resp = client.get(f"/users/{self.username}", headers={"Accept-Encoding": "gzip"})
+                self.assertNotIn("Content-Encoding", resp.headers)
+            finally:
+                app.config['COMPRESS_MIN_SIZE'] = 1024
+            client.get("/logout")
+
     def test_delete_user(self):
         with app.test_client() as client:            
             """Set the session variable to be deleted then test delete"""
@@ -117,11 +779,70 @@ class AppTestCase(TestCase):
             before = db.session.query(User).count()
             resp = client.post(f"/users/{self.username}/delete", follow_redirects=True)
             html = resp.get_data(as_text=True)
-            after = db.session.query(User).count()
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<p class="lead">Register for our site.</p>', html)
-            self.assertEqual(before - 1, after)
-            
+
+            """The account is gone at once, the row once its feedback is purged"""
+            self.assertIsNone(User.get_profile(self.username))
+            self.assertFalse(User.authenticate(self.username, "Password1"))
+            self.assertEqual(db.session.query(User).count(), before)
+            result = app.test_cli_runner().invoke(args=["data", "purge-deleted"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("1 feedback rows deleted", result.output)
+            self.assertEqual(db.session.query(User).count(), before - 1)
+            self.assertEqual(db.session.query(Feedback).count(), 0)
+
+    def test_delete_user_not_owner(self):
+        User.register_user("OtherUser", "OtherPassword", "Other@test.com", "OtherFirst", "OtherLast")
+        with app.test_client() as client:
+            """Logged out, or logged in as someone else, the account stays"""
+            resp = client.post(f"/users/{self.username}/delete")
+            self.assertEqual(resp.status_code, 302)
+            client.post("/login", data={"username": "OtherUser", "password": "OtherPassword"})
+            resp = client.post(f"/users/{self.username}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.filter_by(username=self.username, deleted_at=None).count(), 1)
+            with client.session_transaction() as sess:
+                self.assertEqual(sess["user_id"], "OtherUser")
+            client.get("/logout")
+            self.assertEqual(client.get("/logout").status_code, 302)
+
+    def test_delete_user_other_session(self):
+        with app.test_client() as client, app.test_client() as other:
+            """Deleting the account logs out its other sessions too"""
+            client.post("/login", data=self.mockLoginForm)
+            other.post("/login", data=self.mockLoginForm)
+            client.post(f"/users/{self.username}/delete")
+
+            resp = other.post(f"/users/{self.username}/feedback/add", data=self.mockFeedbackForm)
+            self.assertEqual(resp.status_code, 302)
+            with other.session_transaction() as sess:
+                self.assertNotIn("user_id", sess)
+            with other.session_transaction() as sess:
+                sess["user_id"] = self.username
+            resp = other.post(f"/feedback/{self.feedback_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(db.session.query(Feedback).count(), 1)
+
+            """Model calls on the deleted user's behalf change nothing"""
+            self.assertIsNone(Feedback.create_feedback("Late", "Late content", self.username))
+            self.assertIsNone(Feedback.create_many([("Late", "Late content")], self.username))
+            self.assertEqual(Feedback.update_feedback(self.feedback_id, "Late", "Late content", self.username), 0)
+            self.assertEqual(Feedback.delete_many({self.feedback_id}, self.username), set())
+            self.assertEqual(Feedback.get_feedback_page(self.username).items, [])
+            self.assertEqual(db.session.query(Feedback).count(), 1)
+
+    def test_delete_user_other_session_api(self):
+        with app.test_client() as client, app.test_client() as other:
+            client.post("/login", data=self.mockLoginForm)
+            other.post("/login", data=self.mockLoginForm)
+            client.post(f"/users/{self.username}/delete")
+            resp = other.post("/api/feedback", json={"items": [self.mockFeedbackForm]})
+            self.assertEqual(resp.status_code, 401)
+            with other.session_transaction() as sess:
+                self.assertNotIn("user_id", sess)
+            self.assertEqual(db.session.query(Feedback).count(), 1)
+
     def test_add_feedback(self):
         with app.test_client() as client:
             """Test GET"""
@@ -0,0 +1,114 @@
+from unittest import TestCase, skipUnless
+import json
+import os
+import subprocess
+import sys
+from testing import TEST_CONFIG, create_database, database_uri
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+# Runs in a fresh interpreter, because monkey-patching has to happen before
+# anything else is imported and must not leak into the other tests.
+SCRIPT = r'''
+from gevent import monkey
+monkey.patch_all()
+import json
+import sys
+import time
+import urllib.request
+import gevent
+from gevent.pywsgi import WSGIServer
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    pass
+from app import create_app
+app = create_app(json.loads(sys.argv[1]))
+from models import db, hasher
+
+WAIT = 0.3
+CLIENTS = 10
+
+@app.route("/_wait")
+def wait():
+    """Stands in for a slow query."""
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("SELECT pg_sleep(%s)" % WAIT)
+    else:
+        gevent.sleep(WAIT)
+    return "ok"
+
+server = WSGIServer(("127.0.0.1", 0), app, log=None)
+server.start()
+url = "http://127.0.0.1:%d/_wait" % server.server_port
+start = time.perf_counter()
+statuses = [job.value for job in gevent.joinall(
+    [gevent.spawn(lambda: urllib.request.urlopen(url).status) for _ in range(CLIENTS)])]
+requests_elapsed = time.perf_counter() - start
+server.stop()
+
+ticks = []
+def heartbeat():
+    while True:
+        ticks.append(time.perf_counter())
+        gevent.sleep(0.005)
+beat = gevent.spawn(heartbeat)
+gevent.sleep(0.02)
+hasher.rounds = 12
+start = time.perf_counter()
+hasher.generate_password_hash("Password1")
+end = time.perf_counter()
+beat.kill()
+hash_seconds = end - start
+# Longest stretch during the hash in which the heartbeat didn't run
+marks = [start] + [tick for tick in ticks if start < tick < end] + [end]
+hub_gap = max(b - a for a, b in zip(marks, marks[1:]))
+
+sessions, stable = {}, {}
+def use_session(n):
+    with app.app_context():
+        sessions[n] = db.session()
+        gevent.sleep(0.01)
+        stable[n] = db.session() is sessions[n]
+gevent.joinall([gevent.spawn(use_session, n) for n in range(2)])
+
+print(json.dumps({
+    "dialect": db.engine.dialect.name, "statuses": statuses, "requests_elapsed": requests_elapsed, "serial": WAIT * CLIENTS,
+    "hash_seconds": hash_seconds, "hub_gap": hub_gap,
+    "distinct_sessions": sessions[0] is not sessions[1], "stable_sessions": all(stable.values()),
+}))
+'''
+
+
+@skipUnless(gevent, "gevent is not installed")
+class GeventWorkerTestCase(TestCase):
+    """The gevent worker setup from gunicorn.conf.py serves requests concurrently."""
+
+    @classmethod
+    def setUpClass(cls):
+        # The test database and config, so the app never touches real data
+        uri = database_uri()
+        create_database(uri)
+        config = json.dumps(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI=uri))
+        out = subprocess.run([sys.executable, "-c", SCRIPT, config], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+        if out.returncode:
+            raise AssertionError(out.stderr)
+        cls.result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    def test_requests_overlap(self):
+        if self.result["dialect"] != "postgresql":
+            self.skipTest("only Postgres queries wait on the network; elsewhere /_wait just sleeps")
+        self.assertEqual(self.result["statuses"], [200] * 10)
+        self.assertLess(self.result["requests_elapsed"], self.result["serial"] / 2)
+
+    def test_bcrypt_does_not_block_hub(self):
+        self.assertLess(self.result["hub_gap"], self.result["hash_seconds"] / 2)
+
+    def test_session_per_greenlet(self):
+        self.assertTrue(self.result["distinct_sessions"])
+        self.assertTrue(self.result["stable_sessions"])
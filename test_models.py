@@ -1,21 +1,23 @@
-from unittest import TestCase
-from app import app
-from models import db, User, Feedback
+from testing import TransactionalTestCase, committing, get_app
+from models import db, User, Feedback, FeedbackRow, FeedbackSummary, PendingDeletion, user_cache, hasher
+from deletion import deletion_worker
 from flask_bcrypt import Bcrypt 
+from sqlalchemy import inspect
+from datetime import timedelta
+import os
+import subprocess
+import sys
+import tempfile
 
-bcrypt = Bcrypt()
+app = get_app()
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///user_feedback'
-app.config['SQLALCHEMY_ECHO'] = False
+bcrypt = Bcrypt(app)
 
-db.drop_all()
-db.create_all()
+class UserModelTestCase(TransactionalTestCase):
 
-class UserModelTestCase(TestCase):
-    
     # ---------------Set up---------------------
     def setUp(self):
-        User.query.delete()
+        super().setUp()
         hashed = bcrypt.generate_password_hash("TestPassword")
         hashed_utf8 = hashed.decode("utf8")
         user = User(username="TestUser", password=hashed_utf8, email="TestEmail@email.com", first_name="TestFirstName", last_name="TestFirstName")
@@ -42,11 +44,37 @@ class UserModelTestCase(TestCase):
         auth = User.authenticate(user.username, self.user_password)
         self.assertTrue(auth)
         
+    def test_authenticate_rehash(self):
+        user = db.session.query(User).first()
+        rounds = hasher.rounds
+        hasher.rounds = 5
+        try:
+            auth = User.authenticate(user.username, self.user_password)
+            self.assertTrue(auth)
+            self.assertEqual(auth.password.split('$')[2], '05')
+            self.assertFalse(hasher.needs_rehash(auth.password))
+            self.assertTrue(User.authenticate(user.username, self.user_password))
+        finally:
+            hasher.rounds = rounds
+        
     def test_get_user_by_username(self):
         user = db.session.query(User).first()
         username = user.username
         user = User.get_user_by_username(username)
         self.assertEqual(username, user.username)
+
+    def test_get_profile_cache(self):
+        user = db.session.query(User).first()
+        self.assertEqual(User.get_profile(user.username).first_name, user.first_name)
+        self.assertEqual(user_cache.get(user.username).first_name, user.first_name)
+
+        """The cached display fields are dropped on commit, not at flush"""
+        user.first_name = "Flushed"
+        db.session.flush()
+        self.assertIsNotNone(user_cache.get(user.username))
+        db.session.commit()
+        self.assertIsNone(user_cache.get(user.username))
+        self.assertEqual(User.get_profile(user.username).first_name, "Flushed")
     
     def test_update_user(self):
         # test changing only username
@@ -84,8 +112,31 @@ class UserModelTestCase(TestCase):
         before = db.session.query(User).count()
         user = db.session.query(User).first()
         User.delete_user(user.username)
+        self.assertIsNone(User.get_user_by_username(user.username))
+        self.assertFalse(User.delete_user(user.username))
+        with app.app_context():
+            deletion_worker.drain()
         after = db.session.query(User).count()
         self.assertEqual(before - 1, after)
+
+    def test_purge_deleted_user(self):
+        for i in range(5):
+            Feedback.create_feedback(f"Title{i}", f"Content{i}", "TestUser")
+        User.delete_user("TestUser")
+        self.assertFalse(User.authenticate("TestUser", self.user_password))
+
+        # Each batch is its own transaction, recorded in pending_deletions and the summary
+        self.assertEqual(PendingDeletion.purge_batch(2), ("TestUser", 2))
+        self.assertEqual(PendingDeletion.query.get("TestUser").deleted_rows, 2)
+        self.assertEqual(Feedback.count_feedback("TestUser"), 3)
+        self.assertEqual(PendingDeletion.purge_batch(2), ("TestUser", 2))
+        self.assertEqual(PendingDeletion.purge_batch(2), ("TestUser", 1))
+        self.assertIsNotNone(db.session.query(User).get("TestUser"))
+        self.assertEqual(PendingDeletion.purge_batch(2), ("TestUser", 0))
+        self.assertIsNone(db.session.query(User).get("TestUser"))
+        self.assertEqual(PendingDeletion.query.count(), 0)
+        self.assertEqual(FeedbackSummary.query.count(), 0)
+        self.assertIsNone(PendingDeletion.purge_batch(2))
         
     # ------------Test Feedback-----------------
     def test_create_feedback(self):
@@ -104,7 +155,58 @@ class UserModelTestCase(TestCase):
         feedback = Feedback.create_feedback("NewFeedbackTitle", "NewFeedbackContent", user.username)
         test_feedback = Feedback.get_feedback_by_username(user.username)
         self.assertEqual(user.username, test_feedback[0].username)
+
+        """Admins get everyone's feedback as rows, in one query"""
+        admin = User.register_user("AdminUser", "AdminPassword", "Admin@email.com", "AdminFirst", "AdminLast")
+        admin.is_admin = True
+        db.session.commit()
+        rows = Feedback.get_feedback_by_username(admin.username)
+        self.assertIsInstance(rows[0], FeedbackRow)
+        self.assertEqual([row.id for row in rows], [f.id for f in Feedback.query.order_by(Feedback.id)])
     
+    def test_get_feedback_page(self):
+        user = db.session.query(User).first()
+        ids = [Feedback.create_feedback(f"Title{i}", "Content", user.username).id for i in range(5)]
+        page = Feedback.get_feedback_page(user.username, per_page=2)
+        self.assertEqual([f.id for f in page], ids[:2])
+        self.assertIsNone(page.prev_cursor)
+        self.assertEqual(page.total, 5)
+        page = Feedback.get_feedback_page(user.username, after=page.next_cursor, per_page=2)
+        self.assertEqual([f.id for f in page], ids[2:4])
+        page = Feedback.get_feedback_page(user.username, after=page.next_cursor, per_page=2)
+        self.assertEqual([f.id for f in page], ids[4:])
+        self.assertIsNone(page.next_cursor)
+        page = Feedback.get_feedback_page(user.username, before=page.prev_cursor, per_page=2)
+        self.assertEqual([f.id for f in page], ids[2:4])
+
+    def test_feedback_rows(self):
+        user = db.session.query(User).first()
+        long_content = "word " * 100
+        feedback = Feedback.create_feedback("LongTitle", long_content, user.username)
+        page = Feedback.get_feedback_page(user.username)
+        row = [row for row in page if row.id == feedback.id][0]
+        self.assertEqual(row.title, "LongTitle")
+        self.assertTrue(row.excerpt.endswith("…"))
+        self.assertLessEqual(len(row.excerpt), Feedback.EXCERPT_LENGTH)
+        self.assertIsInstance(row, FeedbackRow)
+
+        Feedback.update_feedback(feedback.id, "ShortTitle", "Short", user.username)
+        self.assertEqual([row.excerpt for row in Feedback.iter_feedback(user.username) if row.id == feedback.id], ["Short"])
+
+    def test_search(self):
+        user = db.session.query(User).first()
+        Feedback.create_feedback("Login bug", "Cannot log in after password reset", user.username)
+        Feedback.create_feedback("Idea", "Add a login with email option", user.username)
+        feedback = Feedback.create_feedback("Unrelated", "Nothing to see", user.username)
+        results = Feedback.search("login", user.username)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(Feedback.search("login", user.username, per_page=1).next_cursor, 2)
+
+        Feedback.update_feedback(feedback.id, "Login speed", "Slow", user.username)
+        self.assertEqual(len(Feedback.search("login", user.username)), 3)
+        Feedback.delete_feedback(feedback.id, user.username)
+        self.assertEqual(len(Feedback.search("login", user.username)), 2)
+
     def test_get_feedback_by_id(self):
         user = db.session.query(User).first()        
         feedback = Feedback.create_feedback("NewFeedbackTitle", "NewFeedbackContent", user.username)
@@ -128,11 +230,88 @@ class UserModelTestCase(TestCase):
         self.assertNotEqual(test_title, test_feedback.title)
         self.assertNotEqual(test_content, test_feedback.content)
         
-    def test_delete_feedback(self):        
+    def test_feedback_ownership(self):
+        user = db.session.query(User).first()
+        feedback = Feedback.create_feedback("NewFeedbackTitle", "NewFeedbackContent", user.username)
+        other = User.register_user("OtherUser", "OtherPassword", "Other@email.com", "OtherFirst", "OtherLast")
+        self.assertFalse(Feedback.authenticate(feedback.id, other.username))
+        self.assertIsNone(Feedback.get_feedback_by_id(feedback.id, other.username))
+        self.assertEqual(Feedback.update_feedback(feedback.id, "Hijacked", "Hijacked", other.username), 0)
+        self.assertEqual(Feedback.delete_feedback(feedback.id, other.username), 0)
+        self.assertEqual(Feedback.get_feedback_by_id(feedback.id).title, "NewFeedbackTitle")
+
+        other.is_admin = True
+        db.session.commit()
+        self.assertTrue(Feedback.authenticate(feedback.id, other.username))
+        self.assertEqual(Feedback.update_feedback(feedback.id, "AdminTitle", "AdminContent", other.username), 1)
+        self.assertEqual(Feedback.delete_feedback(feedback.id, user.username), 1)
+
+    @committing
+    def test_feedback_summary(self):
+        user = db.session.query(User).first()
+        first = Feedback.create_feedback("First", "Content", user.username)
+        second = Feedback.create_feedback("Second", "Content", user.username)
+        summary = FeedbackSummary.query.get(user.username)
+        self.assertEqual(summary.feedback_count, 2)
+        self.assertEqual(summary.last_feedback_at, second.created_at)
+        self.assertEqual(Feedback.get_feedback_page(user.username).total, 2)
+
+        other = User.register_user("OtherUser", "OtherPassword", "Other@email.com", "OtherFirst", "OtherLast")
+        self.assertEqual(Feedback.delete_feedback(second.id, other.username), 0)
+        self.assertEqual(Feedback.delete_feedback(second.id, user.username), 1)
+        db.session.expire_all()
+        summary = FeedbackSummary.query.get(user.username)
+        self.assertEqual(summary.feedback_count, 1)
+        self.assertEqual(summary.last_feedback_at, first.created_at)
+
+        """Every write to a user's feedback bumps their version, including a rebuild"""
+        self.assertEqual(FeedbackSummary.get_version(user.username), 3)
+        Feedback.update_feedback(first.id, "Edited", "Content")
+        self.assertEqual(FeedbackSummary.get_version(user.username), 4)
+        self.assertEqual(FeedbackSummary.get_version("NoSuchUser"), 0)
+
+        page = FeedbackSummary.get_summary_page(per_page=1)
+        self.assertEqual([(row.username, row.feedback_count) for row in page], [("OtherUser", 0)])
+        page = FeedbackSummary.get_summary_page(after=page.next_cursor, per_page=1)
+        self.assertEqual([(row.username, row.feedback_count) for row in page], [(user.username, 1)])
+        self.assertIsNone(page.next_cursor)
+
+        summary.feedback_count = 42
+        db.session.commit()
+        with db.engine.begin() as connection:
+            self.assertEqual(FeedbackSummary.rebuild(connection), 1)
+        db.session.expire_all()
+        self.assertEqual(FeedbackSummary.query.get(user.username).feedback_count, 1)
+        self.assertEqual(FeedbackSummary.get_version(user.username), 5)
+
+        """A buffered row older than the newest one counts but leaves last_feedback_at"""
+        Feedback.insert_batch([dict(title="Late", content="Content", username=user.username,
+                                    created_at=first.created_at - timedelta(minutes=5))])
+        db.session.expire_all()
+        summary = FeedbackSummary.query.get(user.username)
+        self.assertEqual(summary.feedback_count, 2)
+        self.assertEqual(summary.last_feedback_at, first.created_at)
+
+    def test_delete_feedback(self):
         user = db.session.query(User).first()
         feedback = Feedback.create_feedback("NewFeedbackTitle", "NewFeedbackContent", user.username)
         before = db.session.query(Feedback).count()
         feedback = db.session.query(Feedback).first()
         Feedback.delete_feedback(feedback.id)
         after = db.session.query(Feedback).count()
-        self.assertEqual(before - 1, after)
\ No newline at end of file
+        self.assertEqual(before - 1, after)
+
+    # ------------Test query plans--------------
+    def test_feedback_indexes(self):
+        indexes = {index["name"]: index["column_names"] for index in inspect(db.session.connection()).get_indexes("feedback")}
+        self.assertEqual(indexes["ix_feedback_username_id"], ["username", "id"])
+        self.assertEqual(indexes["ix_feedback_username_created_at"], ["username", "created_at"])
+
+    def test_query_plans(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = subprocess.run([sys.executable, "explain.py", "--database", "sqlite:///" + os.path.join(tmp, "explain.db"),
+                                  "--size", "2000", "--min-rows", "1000"],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        self.assertIn("Feedback.get_feedback_page", out.stderr)
@@ -0,0 +1,158 @@
+"""
+Fixtures for the test suite.
+
+Every test module shares one app, built by get_app() from TEST_CONFIG
+against TEST_DATABASE_URL, whose schema is created once per process.
+TransactionalTestCase wraps each test in a transaction that is rolled
+back afterwards, so tests neither clean up nor see each other's rows.
+
+`pytest -n auto` (pytest-xdist, see requirements-dev.txt) runs the suite
+in parallel. Each worker gets its own database, named after its worker id.
+"""
+import copy
+import os
+from unittest import TestCase
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'WTF_CSRF_ENABLED': False,
+    'SQLALCHEMY_ECHO': False,
+    # bcrypt's minimum. Production hashes are still checked, just slower.
+    'BCRYPT_LOG_ROUNDS': 4,
+    # No background threads; tests drain and flush themselves
+    'USER_DELETE_WORKER': False,
+    'FEEDBACK_BUFFER_ENABLED': False,
+    'METRICS_TOKEN': 'test-metrics-token',
+}
+
+_app = None
+
+
+def database_uri():
+    """TEST_DATABASE_URL, with the pytest-xdist worker id appended to the
+    database name when running in parallel."""
+    url = make_url(os.environ.get('TEST_DATABASE_URL', 'postgresql:///feedback_test'))
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker and url.database and url.database != ':memory:':
+        if url.drivername.startswith('sqlite'):
+            root, ext = os.path.splitext(url.database)
+            url.database = '%s_%s%s' % (root, worker, ext)
+        else:
+            url.database = '%s_%s' % (url.database, worker)
+    return str(url)
+
+
+def create_database(uri):
+    """Create the Postgres database `uri` names if it doesn't exist yet.
+    SQLite creates its file on connect."""
+    url = make_url(uri)
+    if not url.drivername.startswith('postgresql'):
+        return
+    server = copy.copy(url)
+    server.database = 'postgres'
+    engine = create_engine(server, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), name=url.database).scalar()
+            if not exists:
+                conn.execute(text('CREATE DATABASE "%s"' % url.database))
+    finally:
+        engine.dispose()
+
+
+def get_app():
+    """The app the tests share, created on first use along with a fresh schema."""
+    global _app
+    if _app is None:
+        from app import create_app
+        from models import db
+        uri = database_uri()
+        create_database(uri)
+        _app = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI=uri))
+        engine = db.get_engine(_app)
+        if engine.dialect.name == 'sqlite':
+            _sqlite_savepoints(engine)
+        db.drop_all()
+        db.create_all()
+    return _app
+
+
+def _sqlite_savepoints(engine):
+    """pysqlite issues BEGIN itself, too late for SAVEPOINT to work. Leave
+    it to SQLAlchemy instead, as its SQLite docs recommend."""
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.execute('BEGIN')
+
+
+def _restart_savepoint(session, transaction):
+    """The app committed or rolled back the test's savepoint; open the next one."""
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def committing(test):
+    """Run this test outside the rollback transaction, for tests whose
+    writes must be seen by other connections or threads. Tables are
+    emptied after it instead."""
+    test.committing = True
+    return test
+
+
+class TransactionalTestCase(TestCase):
+    """
+    Runs each test in a transaction on one connection that is rolled back
+    when it ends. db.session is bound to that connection for the test,
+    and the app's commits and rollbacks end a savepoint inside it. Caches
+    are cleared before each test.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+
+    def setUp(self):
+        from models import user_cache, page_cache
+        user_cache.clear()
+        page_cache.clear()
+        if getattr(getattr(self, self._testMethodName), 'committing', False):
+            self.addCleanup(self._empty_tables)
+        else:
+            self._begin()
+
+    def _begin(self):
+        from models import db
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        factory = db.create_session({'bind': connection, 'binds': {}})
+        event.listen(factory, 'after_transaction_end', _restart_savepoint)
+
+        def session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        saved = db.session
+        db.session = scoped_session(session, scopefunc=saved.registry.scopefunc)
+
+        def rollback():
+            db.session.remove()
+            db.session = saved
+            transaction.rollback()
+            connection.close()
+        self.addCleanup(rollback)
+
+    def _empty_tables(self):
+        from models import db
+        db.session.remove()
+        with db.engine.begin() as conn:
+            for table in reversed(db.metadata.sorted_tables):
+                conn.execute(table.delete())
@@ -0,0 +1,210 @@
+from flask import Blueprint, Response, abort, current_app, request, redirect, render_template, url_for, session, flash, make_response, stream_with_context
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from models import db, page_cache, User, Feedback, FeedbackSummary
+from hashing import HashingBusy
+from admission import admission
+from buffer import feedback_buffer
+from forms import LoginForm, RegisterForm, FeedbackForm
+
+bp = Blueprint("views", __name__)
+
+def logged_in():
+    """Profile of the logged-in user, or None. A session whose account has
+    been deleted, say from another device, is logged out here."""
+    username = session.get("user_id")
+    if username is None:
+        return None
+    user = User.get_profile(username)
+    if user is None:
+        session.pop("user_id")
+    return user
+
+@bp.app_errorhandler(404)
+def error404(error):
+    return "<h1>Feedback not found</h1>", 404
+
+@bp.app_errorhandler(401)
+def error401(error):
+    return "<h1>User not authorized</h1>", 401
+
+@bp.app_errorhandler(HashingBusy)
+def error_hashing_busy(error):
+    """Every bcrypt slot stayed taken for BCRYPT_QUEUE_TIMEOUT."""
+    return admission.overloaded()
+
+@bp.app_errorhandler(PoolTimeout)
+def error_pool_timeout(error):
+    """No database connection freed up within DB_POOL_TIMEOUT."""
+    db.session.rollback()
+    return admission.overloaded()
+
+@bp.route("/")
+def do_home():   
+    # session.pop("user_id") 
+    return redirect(url_for(".register"))
+    
+@bp.route("/register", methods=['GET', 'POST'])
+def register():
+    """Register a new user"""
+    loggedin = logged_in()
+    if loggedin != None:
+        return redirect(url_for(".secret", username=loggedin.username))
+    
+    form = RegisterForm()    
+    if form.validate_on_submit():
+        usr = form.username.data
+        pwd = form.password.data
+        email = form.email.data
+        first_name = form.first_name.data
+        last_name = form.last_name.data
+        reg = User.register_user(usr, pwd, email, first_name, last_name)
+        if reg:
+            session["user_id"] = first_name
+            return redirect(url_for(".secret", username=first_name))
+        else:
+            flash("Username and email must be unique")
+    return render_template("register.html", form=form, user=False)            
+        
+@bp.route("/login", methods=['GET', 'POST'])
+def login():
+    """Login a user"""
+    loggedin = logged_in()
+    if loggedin != None:
+        return redirect(url_for(".secret", username=loggedin.username))
+    form = LoginForm()
+    if form.validate_on_submit():
+        usr = form.username.data
+        pwd = form.password.data
+        login = User.authenticate(usr, pwd)
+        if login:
+            session["user_id"] = login.username
+            return redirect(url_for(".secret", username=login.username))
+        
+        flash(u"username and password don't match", "error")
+    return render_template("login.html", form=form, user=False)
+        
+@bp.route("/users/<username>")
+def secret(username):
+    user = logged_in()
+    if user is not None and user.username == username:
+        if request.args.get("all"):
+            return stream_template("secret.html", user=user, feedback=Feedback.iter_feedback(username), page=None)
+        after = request.args.get("after", type=int)
+        before = request.args.get("before", type=int)
+        # Pages are keyed on the profile they show and the owner's summary
+        # version. Admin pages list everyone's feedback, pending flash
+        # messages are part of the page and replicas may lag, so renders
+        # with any of those are never cached.
+        cacheable = not user.is_admin and not session.get("_flashes")
+        key = (user, FeedbackSummary.get_version(username), after, before) if cacheable else None
+        cached = page_cache.get(key) if cacheable else None
+        if cached is None:
+            page = Feedback.get_feedback_page(username, after=after, before=before)
+            html = render_template("secret.html", user=user, feedback=page.items, page=page)
+            cached = page_cache.set(key, html) if cacheable and not db.read_replica() else page_cache.entry(html)
+        response = make_response(cached[0])
+        response.set_etag(cached[1])
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
+    else:
+        return redirect(url_for(".register"))    
+
+def stream_template(template_name, **context):
+    """Render a template in pieces as it is iterated, so rows pulled from a
+    cursor are written out instead of collected into one big string."""
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(current_app.config['TEMPLATE_STREAM_BUFFER'])
+    return Response(stream_with_context(stream), headers={"X-Accel-Buffering": "no"})
+
+@bp.route("/users/<username>/delete", methods=['POST'])
+def delete_user(username):
+    """Remove the user from the database and make sure to also delete all of their feedback. Remove the user from the database and make sure to also delete all of their feedback. Clear any user information in the session and redirect to /. Make sure that only the user who is logged in can successfully delete their account"""
+    user = logged_in()
+    if user is None or user.username != username:
+        return redirect(url_for(".do_home"))
+    session.pop("user_id")
+    User.delete_user(username)
+    return redirect(url_for(".do_home"))
+
+@bp.route("/users/<username>/feedback/add", methods=['GET', 'POST'])
+def add_feedback(username):
+    """
+    GET - Display a form to add feedback Make sure that only the user who is logged in can see this form
+    POST - Add a new piece of feedback and redirect to /users/<username> — Make sure that only the user who is logged in can successfully add feedback
+    """
+    user = logged_in()
+    if user is None or user.username != username:
+        return redirect(url_for(".do_home"))
+    form = FeedbackForm()
+    if form.validate_on_submit():
+        title = form.title.data
+        content = form.content.data
+        if feedback_buffer.add(title, content, username):
+            flash("Thanks! Your feedback will show up in a moment.", "info")
+        else:
+            Feedback.create_feedback(title, content, username)
+        return redirect(url_for(".do_home"))
+    else:
+        return render_template("add_feedback.html", form=form, username=username)
+
+@bp.route("/admin/summary")
+def admin_summary():
+    """Feedback count and latest feedback per user, a page of users at a time. Admins only."""
+    user = logged_in()
+    if user is None:
+        return redirect(url_for(".do_home"))
+    if not user.is_admin:
+        abort(401)
+    summary = FeedbackSummary.get_summary_page(after=request.args.get("after"), before=request.args.get("before"))
+    return render_template("admin_summary.html", user=user, summary=summary)
+
+@bp.route("/feedback/search")
+def search_feedback():
+    """Full-text search over feedback. Admins see every match, other users only their own."""
+    user = logged_in()
+    if user is None:
+        return redirect(url_for(".do_home"))
+    q = request.args.get("q", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    results = Feedback.search(q, user.username, page=page)
+    return render_template("search.html", user=user, q=q, results=results)
+
+@bp.route("/feedback/<int:feedback_id>/update", methods=['GET', 'POST'])
+def update_feedback(feedback_id):
+    """
+    GET - Display a form to edit feedback — **Make sure that only the user who has written that feedback can see this form **
+    POST - Update a specific piece of feedback and redirect to /users/<username> — Make sure that only the user who has written that feedback can update it
+    """
+    user = logged_in()
+    if user is None:
+        return redirect(url_for(".do_home"))
+    username = user.username
+    form = FeedbackForm()
+    if form.validate_on_submit():
+        title = form.title.data
+        content = form.content.data
+        Feedback.update_feedback(feedback_id, title, content, username)
+        return redirect(url_for(".do_home"))
+    
+    feedback = Feedback.get_feedback_by_id(feedback_id, username)
+    if feedback is None:
+        return redirect(url_for(".do_home"))
+    return render_template("update_feedback.html", form=form, feedback=feedback)    
+        
+@bp.route("/feedback/<int:feedback_id>/delete", methods=['POST'])
+def delete_feedback(feedback_id):
+    """
+    POST - Delete a specific piece of feedback and redirect to /users/<username> — Make sure that only the user who has written that feedback can delete it
+    """    
+    user = logged_in()
+    if user is not None:
+        Feedback.delete_feedback(feedback_id, user.username)
+    return redirect(url_for(".do_home"))
+
+@bp.route("/logout")
+def logout():
+    session.pop("user_id", None)
+    return redirect(url_for(".register"))
+
+
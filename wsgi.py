@@ -0,0 +1,4 @@
+from app import create_app, load_templates
+
+app = create_app()
+load_templates(app)